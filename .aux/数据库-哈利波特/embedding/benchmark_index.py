@@ -0,0 +1,126 @@
+"""
+比较不同合并索引类型的召回率和速度
+
+以flat精确搜索的结果为标准，报告各索引类型、向量编码（及不同nprobe / efSearch）的
+recall@k、单条查询的QPS、p50 / p99延迟和每个向量占用的字节数。有损编码可加--rerank，
+用全精度向量对rerank*k个候选精确重排。向量取自已构建好的各batch索引（始终为flat），
+查询向量为随机抽取的文本块向量加少量噪声后重新归一化，不需要加载编码模型。
+
+用法:
+    python benchmark_index.py --k 10 --queries 500 --types flat ivf hnsw --encodings flat sq8 pq --rerank 4
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+from processor import CONFIG, build_index
+
+def load_vectors():
+    """按manifest中的顺序读出所有batch的向量，顺序与合并索引的向量id一致"""
+    output_dir = CONFIG["output_dir"]
+    with open(os.path.join(output_dir, CONFIG.get("manifest_name", "manifest.json")), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    vectors = []
+    for batch in manifest["batches"]:
+        # 通过numpy读取再反序列化，避免faiss无法打开中文路径
+        index = faiss.deserialize_index(np.fromfile(os.path.join(output_dir, batch["file_name"]), dtype=np.uint8))
+        vectors.append(index.reconstruct_n(0, index.ntotal))
+    return np.ascontiguousarray(np.concatenate(vectors), dtype=np.float32)
+
+def make_queries(vectors, num_queries, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)].copy()
+    queries += rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+def run_queries(index, queries, k, vectors=None, rerank=0):
+    """
+    逐条查询（与聊天程序的使用方式一致），返回(结果id, 每条查询的耗时秒数)
+
+    rerank大于0时取rerank*k个候选，用全精度向量vectors重新计算距离后取前k个
+    """
+    results = np.full((len(queries), k), -1, dtype=np.int64)
+    latencies = np.empty(len(queries))
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        if rerank > 0:
+            _, indices = index.search(queries[i:i+1], k * rerank)
+            ids = indices[0][indices[0] >= 0]
+            exact = ((vectors[ids] - queries[i]) ** 2).sum(axis=1)
+            found = ids[np.argsort(exact, kind="stable")[:k]]
+        else:
+            _, indices = index.search(queries[i:i+1], k)
+            found = indices[0]
+        latencies[i] = time.perf_counter() - start
+        results[i, :len(found)] = found
+    return results, latencies
+
+def recall_at_k(results, ground_truth):
+    k = ground_truth.shape[1]
+    hits = sum(len(np.intersect1d(found, truth)) for found, truth in zip(results, ground_truth))
+    return hits / (len(ground_truth) * k)
+
+def benchmark(vectors, queries, k, index_types, encodings, nprobes, ef_searches, rerank=0):
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, ground_truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        for encoding in encodings:
+            start = time.perf_counter()
+            index = build_index(vectors, index_type, encoding)
+            build_seconds = time.perf_counter() - start
+            bytes_per_vector = len(faiss.serialize_index(index)) / len(vectors)
+            if index_type == "ivf":
+                sweep = [("nprobe", n) for n in nprobes]
+            elif index_type == "hnsw":
+                sweep = [("efSearch", ef) for ef in ef_searches]
+            else:
+                sweep = [(None, None)]
+            # 无损的flat编码不需要重排
+            reranks = [0] if encoding == "flat" or rerank <= 0 else [0, rerank]
+            for param, value in sweep:
+                if param is not None:
+                    faiss.ParameterSpace().set_index_parameter(index, param, value)
+                for factor in reranks:
+                    results, latencies = run_queries(index, queries, k, vectors, factor)
+                    name = f"{index_type}/{encoding}" + ("" if param is None else f" {param}={value}")
+                    rows.append({
+                        "index": name + (f" rerank={factor}" if factor else ""),
+                        "build_s": build_seconds,
+                        "bytes_per_vector": bytes_per_vector,
+                        "recall": recall_at_k(results, ground_truth),
+                        "qps": len(queries) / latencies.sum(),
+                        "p50_ms": np.percentile(latencies, 50) * 1000,
+                        "p99_ms": np.percentile(latencies, 99) * 1000,
+                    })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="比较不同合并索引类型和向量编码的recall@k、QPS、p99延迟和字节/向量")
+    parser.add_argument("--k", type=int, default=10, help="recall@k中的k")
+    parser.add_argument("--queries", type=int, default=500, help="查询数量")
+    parser.add_argument("--noise", type=float, default=0.02, help="加到查询向量上的高斯噪声标准差")
+    parser.add_argument("--types", nargs="+", default=["flat", "ivf", "hnsw"], help="要比较的索引类型")
+    parser.add_argument("--encodings", nargs="+", default=["flat"], help="要比较的向量编码（flat / fp16 / sq8 / pq）")
+    parser.add_argument("--rerank", type=int, default=0, help="有损编码时额外测试取rerank*k个候选精确重排，0表示不测试")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32], help="IVF搜索时扫描的聚类数")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128], help="HNSW搜索时的候选列表长度")
+    args = parser.parse_args()
+
+    vectors = load_vectors()
+    queries = make_queries(vectors, args.queries, args.noise)
+    print(f"\033[94m{len(vectors)}个向量（{vectors.shape[1]}维），{len(queries)}条查询，k={args.k}\033[0m")
+
+    rows = benchmark(vectors, queries, args.k, args.types, args.encodings, args.nprobe, args.ef_search, args.rerank)
+    print(f"{'索引':<36}{'构建(s)':>10}{'字节/向量':>12}{'recall@' + str(args.k):>12}{'QPS':>10}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for row in rows:
+        print(f"{row['index']:<36}{row['build_s']:>10.2f}{row['bytes_per_vector']:>12.1f}{row['recall']:>12.4f}"
+              f"{row['qps']:>10.0f}{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import re
+import numpy as np
+
+# 只保留汉字、字母和数字，标点和空白处断开（不跨标点组成二元组）
+_TOKEN_RUN = re.compile(r"[0-9A-Za-z㐀-䶿一-鿿豈-﫿]+")
+
+def char_bigrams(text):
+    """
+    将文本切分为字二元组（例如"赫敏的魔杖" -> 赫敏 敏的 的魔 魔杖）
+
+    字母统一转为小写；长度为1的片段保留单字，保证单字查询也能命中
+    """
+    terms = []
+    for run in _TOKEN_RUN.findall(text.lower()):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i+2] for i in range(len(run) - 1))
+    return terms
+
+
+class BM25Index:
+    """
+    基于字二元组的BM25倒排索引，文档编号与合并FAISS索引中的向量id一一对应
+
+    倒排表用数组存储（CSR格式）：词表按字典序排列，第t个词的倒排为
+    doc_ids[offsets[t]:offsets[t+1]]及对应的词频tfs，查询时用二分查找定位词
+    """
+    def __init__(self, terms, offsets, doc_ids, tfs, doc_lengths, k1=1.2, b=0.75):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = float(k1)
+        self.b = float(b)
+        self.num_docs = len(doc_lengths)
+        self.avg_length = float(doc_lengths.mean()) if self.num_docs else 0.0
+        # 文档长度归一化部分与查询无关，预先算好
+        self._length_norm = (self.k1 * (1.0 - self.b + self.b * doc_lengths / max(self.avg_length, 1e-9))).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts, k1=1.2, b=0.75):
+        """从按向量id排列的文本列表构建索引"""
+        term_ids = {}
+        postings_terms = []
+        postings_docs = []
+        postings_tfs = []
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc_id, text in enumerate(texts):
+            terms = char_bigrams(text)
+            doc_lengths[doc_id] = len(terms)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                postings_terms.append(term_ids.setdefault(term, len(term_ids)))
+                postings_docs.append(doc_id)
+                postings_tfs.append(tf)
+
+        # 按词的字典序重新编号，再按(词, 文档)排序得到CSR格式的倒排表
+        vocabulary = sorted(term_ids)
+        remap = np.empty(len(term_ids), dtype=np.int32)
+        for new_id, term in enumerate(vocabulary):
+            remap[term_ids[term]] = new_id
+        postings_terms = remap[np.asarray(postings_terms, dtype=np.int32)]
+        postings_docs = np.asarray(postings_docs, dtype=np.int32)
+        order = np.lexsort((postings_docs, postings_terms))
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(postings_terms, minlength=len(vocabulary)), out=offsets[1:])
+        return cls(
+            np.array(vocabulary, dtype="<U2"),
+            offsets,
+            postings_docs[order],
+            np.asarray(postings_tfs, dtype=np.int32)[order],
+            doc_lengths,
+            k1, b
+        )
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, terms=self.terms, offsets=self.offsets, doc_ids=self.doc_ids, tfs=self.tfs,
+                     doc_lengths=self.doc_lengths, params=np.array([self.k1, self.b]))
+
+    @classmethod
+    def load(cls, path):
+        # 通过文件对象读取，避免中文路径问题
+        with open(path, 'rb') as f:
+            data = np.load(f)
+            k1, b = data["params"]
+            return cls(data["terms"], data["offsets"], data["doc_ids"], data["tfs"], data["doc_lengths"], k1, b)
+
+    def _postings(self, term):
+        position = np.searchsorted(self.terms, term)
+        if position >= len(self.terms) or self.terms[position] != term:
+            return None
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.doc_ids[start:end], self.tfs[start:end]
+
+    def scores(self, query):
+        """返回所有文档对查询的BM25分数（查询中重复出现的词按次数累加）"""
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        query_counts = {}
+        for term in char_bigrams(query):
+            query_counts[term] = query_counts.get(term, 0) + 1
+        for term, query_tf in query_counts.items():
+            postings = self._postings(term)
+            if postings is None:
+                continue
+            doc_ids, tfs = postings
+            idf = np.log(1.0 + (self.num_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            scores[doc_ids] += query_tf * idf * tfs * (self.k1 + 1.0) / (tfs + self._length_norm[doc_ids])
+        return scores
+
+    def search(self, query, k):
+        """返回(分数, 文档id)，按分数从高到低排列，只包含分数大于0的文档"""
+        scores = self.scores(query)
+        k = min(k, self.num_docs)
+        if k <= 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[scores[top] > 0]
+        return scores[top], top
@@ -0,0 +1,158 @@
+import os
+import re
+import json
+import hashlib
+
+# 章节标题（第N章）总是开始一个新的文本块，文本块不跨章节
+HEADING_PATTERN = re.compile(r"^第[0-9０-９一二三四五六七八九十百千零〇两]+章")
+# 句子以。！？结尾，句末的引号、括号归入本句；没有句末标点的剩余部分单独成句
+SENTENCE_PATTERN = re.compile(r"[^。！？!?]*[。！？!?]+[”’」』\"')）]*|[^。！？!?]+")
+
+
+def split_units(data):
+    """
+    把原文按行、句切分为最小单元，返回[(文本, 行号, 字节起点, 字节终点, 是否章节标题)]
+
+    行号从1开始，字节偏移为[起点, 终点)，去掉了每行首尾的空白
+    """
+    units = []
+    offset = 0
+    if data.startswith(b"\xef\xbb\xbf"):
+        offset = 3
+    for line_no, raw_line in enumerate(data[offset:].split(b"\n"), 1):
+        line = raw_line.decode('utf-8', errors='ignore')
+        stripped = line.strip()
+        if stripped:
+            line_start = offset + len(line[:len(line) - len(line.lstrip())].encode('utf-8'))
+            if HEADING_PATTERN.match(stripped):
+                units.append((stripped, line_no, line_start, line_start + len(stripped.encode('utf-8')), True))
+            else:
+                for match in SENTENCE_PATTERN.finditer(stripped):
+                    sentence = match.group().strip()
+                    if not sentence:
+                        continue
+                    leading = len(match.group()) - len(match.group().lstrip())
+                    start = line_start + len(stripped[:match.start() + leading].encode('utf-8'))
+                    units.append((sentence, line_no, start, start + len(sentence.encode('utf-8')), False))
+        offset += len(raw_line) + 1
+    return units
+
+
+def _fit_units(units, tokenizer, chunk_tokens):
+    """
+    用真实的tokenizer统计每个单元的token数，超过chunk_tokens的长句按token边界再切开
+
+    返回:
+        tuple: (单元列表, 每个单元的token数)
+    """
+    if not units:
+        return [], []
+    encodings = tokenizer([unit[0] for unit in units], add_special_tokens=False, return_offsets_mapping=True)
+    fitted = []
+    counts = []
+    for unit, offsets in zip(units, encodings["offset_mapping"]):
+        if len(offsets) <= chunk_tokens:
+            fitted.append(unit)
+            counts.append(len(offsets))
+            continue
+        text, line_no, byte_start, _, is_heading = unit
+        for i in range(0, len(offsets), chunk_tokens):
+            piece = offsets[i:i + chunk_tokens]
+            char_start = 0 if i == 0 else piece[0][0]
+            char_end = len(text) if i + chunk_tokens >= len(offsets) else offsets[i + chunk_tokens][0]
+            start = byte_start + len(text[:char_start].encode('utf-8'))
+            end = byte_start + len(text[:char_end].encode('utf-8'))
+            fitted.append((text[char_start:char_end], line_no, start, end, is_heading and i == 0))
+            counts.append(len(piece))
+    return fitted, counts
+
+
+def _windows(counts, chunk_tokens, overlap):
+    """在一个章节内按token数划分滑动窗口，相邻窗口重叠不超过overlap个token，返回[(起始单元, 结束单元)]"""
+    windows = []
+    i = 0
+    while i < len(counts):
+        j = i
+        total = 0
+        while j < len(counts) and (j == i or total + counts[j] <= chunk_tokens):
+            total += counts[j]
+            j += 1
+        windows.append((i, j))
+        if j >= len(counts):
+            break
+        # 从窗口末尾往回取不超过overlap个token的单元作为下一个窗口的开头（至少前进一个单元）
+        k = j
+        back = 0
+        while k - 1 > i and back + counts[k - 1] <= overlap:
+            k -= 1
+            back += counts[k]
+        i = k
+    return windows
+
+
+def chunk_text(data, tokenizer, chunk_tokens, overlap):
+    """
+    把一个文件的原始字节切分为文本块
+
+    按句子和段落累积到chunk_tokens个token为一个文本块，相邻文本块重叠约overlap个token，
+    章节标题处强制断开。原文中的每个token都至少落在一个文本块中。
+
+    返回:
+        tuple: (文本列表, 原文位置列表[(起始行, 结束行, 字节起点, 字节终点)])
+    """
+    units, counts = _fit_units(split_units(data), tokenizer, chunk_tokens)
+
+    # 先按章节标题分段，窗口不跨章节（目录中连续的标题行归入同一段，避免产生大量只有一行的文本块）
+    sections = []
+    has_body = False
+    for index, unit in enumerate(units):
+        if not sections or (unit[4] and has_body):
+            sections.append([])
+            has_body = False
+        sections[-1].append(index)
+        has_body = has_body or not unit[4]
+
+    texts = []
+    spans = []
+    for section in sections:
+        section_counts = [counts[index] for index in section]
+        for start, end in _windows(section_counts, chunk_tokens, overlap):
+            window = [units[index] for index in section[start:end]]
+            parts = [window[0][0]]
+            for previous, unit in zip(window, window[1:]):
+                # 同一行的句子直接相连，换行处保留换行符
+                parts.append(unit[0] if unit[1] == previous[1] else "\n" + unit[0])
+            texts.append("".join(parts))
+            spans.append((window[0][1], window[-1][1], window[0][2], window[-1][3]))
+    return texts, spans
+
+
+class ChunkCache:
+    """
+    切分结果的磁盘缓存，键为(文件内容哈希, 切分参数)
+
+    同样的文件在切分参数不变时直接复用上次的结果（重新编码、换模型或并行构建时都不必重新分句和统计token）
+    """
+    def __init__(self, cache_dir, settings):
+        self.cache_dir = cache_dir
+        self.settings_key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, data):
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(data).hexdigest()}_{self.settings_key}.json")
+
+    def get(self, data):
+        path = self._path(data)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        return cached["texts"], [tuple(span) for span in cached["spans"]]
+
+    def put(self, data, texts, spans):
+        # 先写临时文件再替换，并行构建的多个进程同时写同一个文件也不会读到半截内容
+        path = self._path(data)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"texts": texts, "spans": spans}, f, ensure_ascii=False)
+        os.replace(temp_path, path)
@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+
+def batched_forward(tokenizer, encodings, batch_size, device, forward, out):
+    """
+    按token长度排序分批计算，长度相近的输入进入同一批，尽量减少padding
+
+    参数:
+        tokenizer: 用于pad的tokenizer
+        encodings: tokenizer未pad的输出（每条输入一个input_ids列表）
+        batch_size (int): 每次前向计算的输入条数
+        device: 模型所在设备
+        forward (callable): forward(模型输入) -> 这一批的numpy结果（第一维与批大小一致）
+        out (np.ndarray): 结果按原输入顺序写入的数组
+
+    返回:
+        np.ndarray: out
+    """
+    order = np.argsort([len(ids) for ids in encodings["input_ids"]], kind="stable")
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            features = [{key: encodings[key][j] for key in encodings.keys()} for j in batch]
+            inputs = tokenizer.pad(features, padding=True, return_tensors='pt').to(device)
+            out[batch] = forward(inputs)
+    return out
+
+def encode_cls(tokenizer, model, texts, max_length, batch_size, device, normalize):
+    """
+    批量编码文本，取[CLS]向量作为文本向量（构建索引和检索时共用，保证两边向量一致）
+
+    返回:
+        tuple: (float32向量矩阵（行顺序与texts一致）, 每段文本截断后的token数列表)
+    """
+    encodings = tokenizer(texts, truncation=True, max_length=max_length)
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+    batched_forward(tokenizer, encodings, batch_size, device,
+                    lambda inputs: model(**inputs).last_hidden_state[:, 0].float().cpu().numpy(), embeddings)
+    if normalize:
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings, [len(ids) for ids in encodings["input_ids"]]
@@ -1,11 +1,20 @@
 import torch
 import os
+import json
+import time
+import hashlib
+import uuid
 import logging
 import shutil  # 新增shutil模块用于文件移动
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from transformers import AutoTokenizer, AutoModel
 import faiss
 import numpy as np
 import yaml
+from bm25 import BM25Index
+from chunking import chunk_text, ChunkCache
+from encoder import encode_cls
+from search_params import apply_search_params
 
 # 获取基础目录
 BASE_DIR = os.getenv("pkl_base_dir", os.path.join(os.path.dirname((os.path.dirname(__file__)))))
@@ -22,11 +31,239 @@ with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
 # 从环境变量覆盖设备配置
 CONFIG['device'] = os.getenv('DEVICE', CONFIG['device'])
 
+# 向量id -> 原文位置的映射表，每行对应合并索引中的一个向量
+# file_id为manifest["batches"]中的下标，行号从1开始（闭区间），字节偏移为[byte_start, byte_end)
+CHUNK_DTYPE = np.dtype([
+    ("file_id", np.int32),
+    ("line_start", np.int32),
+    ("line_end", np.int32),
+    ("byte_start", np.int64),
+    ("byte_end", np.int64),
+])
+
+def _batch_number(filename):
+    """从batch_N.txt / batch_N.index中取出序号N，用于排序"""
+    return int(filename.split("_")[1].split(".")[0])
+
+def _build_file_name(name, build_id):
+    """在文件名和扩展名之间插入构建编号（merged.index -> merged.<构建编号>.index），每次构建的文件互不重名"""
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{build_id}{ext}"
+
+def _manifest_files(manifest):
+    """manifest引用的全部数据文件名（合并索引、映射表、段落库、BM25索引、全精度向量和各batch索引）"""
+    if not manifest:
+        return set()
+    names = {manifest.get(key) for key in ("index_file", "vector_store", "chunk_table", "bm25_index", "passages", "passage_offsets")}
+    names.update(batch["file_name"] for batch in manifest.get("batches", []))
+    names.discard(None)
+    return names
+
+def _file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def _build_settings():
+    """影响向量结果的构建参数，任何一项变化都需要全部重建"""
+    return {
+        "model_name": CONFIG["model_name"],
+        "max_length": CONFIG["max_length"],
+        "normalize": CONFIG["normalize"],
+        "chunking": _chunk_settings(),
+    }
+
+def _index_settings():
+    """影响合并索引结构的参数，变化时只需用已有向量重建合并索引，不需要重新编码"""
+    return {
+        "index_type": CONFIG.get("index_type", "flat"),
+        "ivf_nlist": CONFIG.get("ivf_nlist", 0),
+        "hnsw_m": CONFIG.get("hnsw_m", 32),
+        "hnsw_ef_construction": CONFIG.get("hnsw_ef_construction", 200),
+        "index_encoding": CONFIG.get("index_encoding", "flat"),
+        "pq_m": CONFIG.get("pq_m", 64),
+        "pq_nbits": CONFIG.get("pq_nbits", 8),
+    }
+
+def _topic_gate_enabled():
+    """配置了两组校准问题且向量归一化时才校准话题判断（分数按余弦相似度计算）"""
+    return bool(CONFIG.get("topic_gate_positive")) and bool(CONFIG.get("topic_gate_negative")) and CONFIG["normalize"]
+
+def _topic_gate_settings():
+    """影响话题判断阈值的参数（校准问题、k、模型和运行时搜索参数），返回其哈希，变化时需要重新校准"""
+    settings = {
+        "model_name": CONFIG["model_name"],
+        "positive": CONFIG.get("topic_gate_positive") or [],
+        "negative": CONFIG.get("topic_gate_negative") or [],
+        "k": CONFIG.get("topic_gate_k", 5),
+        "ivf_nprobe": CONFIG.get("ivf_nprobe", 8),
+        "hnsw_ef_search": CONFIG.get("hnsw_ef_search", 64),
+    }
+    return hashlib.sha256(json.dumps(settings, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _set_num_threads(num_threads):
+    """设置torch的计算线程数，0表示使用全部CPU核心"""
+    torch.set_num_threads(num_threads or os.cpu_count() or 1)
+
+def _encode_texts(tokenizer, model, texts, logger):
+    """
+    批量编码文本块，返回float32向量矩阵（行顺序与texts一致）
+    
+    按token长度排序分批以减少padding（与检索器共用embedding/encoder.py）
+    """
+    if not texts:
+        return np.zeros((0, model.config.hidden_size), dtype=np.float32)
+    
+    start_time = time.perf_counter()
+    embeddings, _ = encode_cls(tokenizer, model, texts, CONFIG["max_length"],
+                               CONFIG.get("encode_batch_size", 32), model.device, CONFIG["normalize"])
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Encoded {len(texts)} chunks in {elapsed:.1f}s ({len(texts) / max(elapsed, 1e-9):.1f} chunks/sec)")
+    return embeddings
+
+def _chunk_settings():
+    """影响切分结果的参数（tokenizer随模型确定），同时作为切分缓存的键"""
+    return {
+        "tokenizer": CONFIG["model_name"],
+        # 留出[CLS]和[SEP]两个位置，保证文本块编码时不会被截断
+        "chunk_tokens": min(CONFIG.get("chunk_tokens", 400), CONFIG["max_length"] - 2),
+        "chunk_overlap": CONFIG.get("chunk_overlap", 64),
+    }
+
+def _chunk_file(tokenizer, file_path):
+    """用真实的tokenizer将文件按句子切分为有重叠的文本块，返回(文本列表, 原文位置列表)；结果按文件内容缓存"""
+    settings = _chunk_settings()
+    cache = ChunkCache(CONFIG.get("chunk_cache_dir") or os.path.join(CONFIG["output_dir"], "chunk_cache"), settings)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    cached = cache.get(data)
+    if cached is not None:
+        return cached
+    texts, chunk_spans = chunk_text(data, tokenizer, settings["chunk_tokens"], settings["chunk_overlap"])
+    cache.put(data, texts, chunk_spans)
+    return texts, chunk_spans
+
+def _embed_files(tokenizer, model, input_path, txt_files, logger):
+    """
+    切分并编码一组文件，返回({文件名: 向量矩阵}, {文件名: 原文位置列表})
+    
+    先切分所有文件，再把全部文本块一起按长度分桶批量编码
+    """
+    file_chunks = {}
+    all_texts = []
+    for txt_file in txt_files:
+        file_path = os.path.join(input_path, txt_file).replace("\\", "/")
+        logger.info(f"Processing file: {file_path}")
+        texts, chunk_spans = _chunk_file(tokenizer, file_path)
+        file_chunks[txt_file] = chunk_spans
+        all_texts.extend(texts)
+    
+    all_embeddings = _encode_texts(tokenizer, model, all_texts, logger)
+    
+    # 按文件拆分向量
+    file_vectors = {}
+    offset = 0
+    for txt_file in txt_files:
+        count = len(file_chunks[txt_file])
+        file_vectors[txt_file] = all_embeddings[offset:offset + count]
+        offset += count
+    return file_vectors, file_chunks
+
+def _encoding_factory(encoding, num_vectors, dimension):
+    """向量编码方式对应的faiss工厂字符串：flat为float32原样存储，fp16 / sq8为标量量化，pq为乘积量化"""
+    if encoding == "flat":
+        return "Flat"
+    if encoding == "fp16":
+        return "SQfp16"
+    if encoding == "sq8":
+        return "SQ8"
+    if encoding == "pq":
+        pq_m = CONFIG.get("pq_m", 64)
+        if dimension % pq_m != 0:
+            raise ValueError(f"pq_m ({pq_m}) must divide the vector dimension ({dimension})")
+        # 每个子空间需要训练2^nbits个聚类中心，语料较小时自动减少位数
+        nbits = max(1, min(CONFIG.get("pq_nbits", 8), int(np.log2(max(num_vectors, 2)))))
+        return f"PQ{pq_m}x{nbits}"
+    raise ValueError(f"Unknown index_encoding: {encoding}")
+
+def build_index(vectors, index_type=None, encoding=None):
+    """
+    按index_type和index_encoding构建合并检索索引
+
+    index_type决定搜索结构：flat为逐个比较；ivf先用k-means训练ivf_nlist个聚类中心，搜索时只扫描nprobe个聚类；
+    hnsw为分层图索引，构建时的邻居数为hnsw_m。搜索参数（nprobe / efSearch）在加载索引时设置。
+    index_encoding决定每个向量的存储方式（flat / fp16 / sq8 / pq），除flat外都需要训练。
+    """
+    index_type = index_type or CONFIG.get("index_type", "flat")
+    encoding = encoding or CONFIG.get("index_encoding", "flat")
+    num_vectors, dimension = vectors.shape
+    code = _encoding_factory(encoding, num_vectors, dimension)
+    if index_type == "flat":
+        factory = code
+    elif index_type == "ivf":
+        nlist = CONFIG.get("ivf_nlist", 0) or int(4 * np.sqrt(num_vectors))
+        # faiss建议每个聚类中心至少有39个训练向量，语料较小时自动减少聚类数
+        nlist = max(1, min(nlist, num_vectors // 39))
+        factory = f"IVF{nlist},{code}"
+    elif index_type == "hnsw":
+        factory = f"HNSW{CONFIG.get('hnsw_m', 32)}" + ("" if code == "Flat" else f"_{code}")
+    else:
+        raise ValueError(f"Unknown index_type: {index_type}")
+    
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_L2)
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = CONFIG.get("hnsw_ef_construction", 200)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+def _topic_scores(index, query_vectors, k):
+    """话题分数：每个问题与语料中最相近的k个文本块的平均余弦相似度（向量已归一化，cos = 1 - L2距离平方 / 2）"""
+    k = min(k, index.ntotal)
+    distances, _ = index.search(np.ascontiguousarray(query_vectors, dtype=np.float32), k)
+    return (1.0 - distances / 2.0).mean(axis=1)
+
+def _make_shards(input_path, txt_files, num_shards):
+    """按文件大小贪心分片，使每个worker的工作量大致相同"""
+    sizes = {f: os.path.getsize(os.path.join(input_path, f)) for f in txt_files}
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for txt_file in sorted(txt_files, key=lambda f: (-sizes[f], _batch_number(f))):
+        target = loads.index(min(loads))
+        shards[target].append(txt_file)
+        loads[target] += sizes[txt_file]
+    return [shard for shard in shards if shard]
+
+# ===== 并行构建时每个worker进程内的模型（只加载一次） =====
+_worker_tokenizer = None
+_worker_model = None
+
+def _init_worker(num_threads):
+    global _worker_tokenizer, _worker_model
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    _set_num_threads(num_threads)
+    _worker_tokenizer = AutoTokenizer.from_pretrained(CONFIG["model_name"])
+    _worker_model = AutoModel.from_pretrained(CONFIG["model_name"]).to(CONFIG["device"])
+    _worker_model.eval()
+
+def _embed_shard(input_path, txt_files):
+    return _embed_files(_worker_tokenizer, _worker_model, input_path, txt_files, logging.getLogger(__name__))
+
 class EmbeddingProcessor:
     def __init__(self):
         self.logger = self._setup_logger()
-        self.tokenizer = AutoTokenizer.from_pretrained(CONFIG["model_name"])
-        self.model = AutoModel.from_pretrained(CONFIG["model_name"]).to(CONFIG["device"])
+        self.tokenizer = None
+        self.model = None
+        # 本次构建写出的文件名都带构建编号，发布时只有替换manifest.json一步会改变检索器看到的内容
+        self.build_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        # 源文件名 -> batch索引文件名（复用的文件沿用上次构建的文件名）
+        self.batch_files = {}
         self._create_output_dir()
         
     def _setup_logger(self):
@@ -40,48 +277,164 @@ class EmbeddingProcessor:
         os.makedirs(CONFIG["output_dir"].replace("\\", "/"), exist_ok=True)
         self.logger.info(f"Output directory created: {CONFIG['output_dir']}")
     
-    def _read_batch(self, filepath):
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return [line.strip() for line in f if line.strip()]
-            
+    def _read_manifest(self):
+        """读取输出目录中当前发布的manifest，不存在时返回None"""
+        manifest_path = os.path.join(CONFIG["output_dir"], CONFIG.get("manifest_name", "manifest.json"))
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def _load_model(self):
+        """串行模式下才在主进程加载模型，并行模式由各worker自行加载"""
+        if self.model is None:
+            _set_num_threads(CONFIG.get("num_threads", 0))
+            self.tokenizer = AutoTokenizer.from_pretrained(CONFIG["model_name"])
+            self.model = AutoModel.from_pretrained(CONFIG["model_name"]).to(CONFIG["device"])
+            self.model.eval()
+    
     def generate_embeddings(self):
         input_path = CONFIG["input_dir"]
-        for txt_file in os.listdir(input_path):
-            if txt_file.endswith(".txt"):
-                file_path = os.path.join(input_path, txt_file).replace("\\", "/")
-                self.logger.info(f"Processing file: {file_path}")
-                
-                texts = self._read_batch(file_path)
-                # 用于存储每个batch的综合embedding
-                batch_embeddings = []
-                
-                for i in range(0, len(texts), CONFIG["batch_size"]):
-                    batch = texts[i:i+CONFIG["batch_size"]]
-                    # 合并batch中的所有文本生成一个综合文本（使用换行符连接）
-                    combined_text = "\n".join(batch)
-                    inputs = self.tokenizer(
-                        combined_text,
-                        padding=True,
-                        truncation=True,
-                        max_length=CONFIG["max_length"],
-                        return_tensors='pt'
-                    ).to(CONFIG["device"])
-                    
-                    with torch.no_grad():
-                        outputs = self.model(**inputs)
-                        batch_embedding = outputs.last_hidden_state[:, 0].cpu().numpy()
-                        if CONFIG["normalize"]:
-                            batch_embedding = batch_embedding / np.linalg.norm(batch_embedding, axis=1, keepdims=True)
-                        # 存储单个batch的embedding
-                        batch_embeddings.append(batch_embedding.tolist()[0])
-                
-                # 将每个batch的embedding转换为numpy数组并保存
-                all_embeddings = np.array(batch_embeddings)
-                self._save_embeddings(all_embeddings, txt_file)
+        txt_files = sorted((f for f in os.listdir(input_path) if f.endswith(".txt")), key=_batch_number)
+        file_hashes = {f: _file_sha256(os.path.join(input_path, f)) for f in txt_files}
+        
+        # 增量模式：内容哈希和构建参数都没变的文件直接复用上次的向量
+        file_vectors, file_chunks = self._load_unchanged(file_hashes) if CONFIG.get("incremental", True) else ({}, {})
+        changed_files = [f for f in txt_files if f not in file_vectors]
+        removed_files = self._remove_deleted(txt_files)
+        if not changed_files and not removed_files and file_vectors and not self._index_settings_changed():
+            self.logger.info("All files unchanged, index is up to date")
+            # 没有话题判断文件（旧版本构建）或校准参数改过时，用已有的合并索引单独重新校准
+            if self._topic_gate_changed():
+                merged_path = os.path.join(CONFIG["output_dir"], self._read_manifest()["index_file"])
+                if self._save_topic_gate(faiss.deserialize_index(np.fromfile(merged_path, dtype=np.uint8))):
+                    self._move_files()
+            return
+        self.logger.info(f"{len(changed_files)} new/changed files to embed, {len(file_vectors)} reused, {len(removed_files)} removed")
+        
+        num_workers = CONFIG.get("num_workers", 1)
+        if num_workers > 1 and len(changed_files) > 1:
+            new_vectors, new_chunks = self._embed_parallel(input_path, changed_files, num_workers)
+        elif changed_files:
+            self._load_model()
+            new_vectors, new_chunks = _embed_files(self.tokenizer, self.model, input_path, changed_files, self.logger)
+        else:
+            new_vectors, new_chunks = {}, {}
+        
+        # 只保存重新编码过的batch索引
+        for txt_file in changed_files:
+            self._save_embeddings(new_vectors[txt_file], txt_file)
+        file_vectors.update(new_vectors)
+        file_chunks.update(new_chunks)
+        
+        # 额外写出合并后的全局索引、向量id映射表和清单文件
+        merged_index = self._save_merged_index(file_vectors, file_chunks, file_hashes)
+        
+        # 用合并索引校准本地话题判断
+        if merged_index is not None:
+            self._save_topic_gate(merged_index)
         
         # 移动临时文件并清理
         self._move_files()
     
+    def _load_unchanged(self, file_hashes):
+        """
+        读取上次构建的manifest，返回未变化文件的({文件名: 向量}, {文件名: 原文位置列表})
+        
+        构建参数（模型、max_length、normalize、切分方式）有任何变化时全部重建
+        """
+        output_dir = CONFIG["output_dir"]
+        manifest = self._read_manifest()
+        if manifest is None:
+            return {}, {}
+        if manifest.get("settings") != _build_settings():
+            self.logger.info("Build settings changed, rebuilding all files")
+            return {}, {}
+        chunk_table_path = os.path.join(output_dir, manifest.get("chunk_table", ""))
+        if not manifest.get("chunk_table") or not os.path.exists(chunk_table_path):
+            return {}, {}
+        chunk_table = np.load(chunk_table_path)
+        
+        file_vectors = {}
+        file_chunks = {}
+        for file_id, batch in enumerate(manifest["batches"]):
+            txt_file = batch["source_file"]
+            index_path = os.path.join(output_dir, batch["file_name"])
+            if file_hashes.get(txt_file) != batch.get("sha256") or not os.path.exists(index_path):
+                continue
+            # 通过numpy读取再反序列化，避免faiss无法打开中文路径
+            index = faiss.deserialize_index(np.fromfile(index_path, dtype=np.uint8))
+            rows = chunk_table[chunk_table["file_id"] == file_id]
+            if index.ntotal != len(rows):
+                continue
+            file_vectors[txt_file] = index.reconstruct_n(0, index.ntotal)
+            self.batch_files[txt_file] = batch["file_name"]
+            file_chunks[txt_file] = [
+                (int(row["line_start"]), int(row["line_end"]), int(row["byte_start"]), int(row["byte_end"]))
+                for row in rows
+            ]
+        return file_vectors, file_chunks
+    
+    def _index_settings_changed(self):
+        manifest = self._read_manifest()
+        if manifest.get("index_settings", {"index_type": "flat"}) != _index_settings():
+            self.logger.info("Index settings changed, rebuilding merged index from existing vectors")
+            return True
+        return False
+    
+    def _topic_gate_changed(self):
+        gate_path = os.path.join(CONFIG["output_dir"], CONFIG.get("topic_gate_name", "topic_gate.json"))
+        if not _topic_gate_enabled():
+            # 话题判断关闭是稳定状态，只有残留的旧文件需要删除
+            return os.path.exists(gate_path)
+        if not os.path.exists(gate_path):
+            return True
+        with open(gate_path, 'r', encoding='utf-8') as f:
+            gate = json.load(f)
+        if gate.get("settings_hash") != _topic_gate_settings():
+            self.logger.info("Topic gate settings changed, recalibrating with existing merged index")
+            return True
+        return False
+    
+    def _remove_deleted(self, txt_files):
+        """
+        返回上次构建中有、输入目录中已不存在的源文件名
+
+        它们的batch索引仍被当前的manifest引用，新构建发布后才由_remove_unreferenced删除
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            return []
+        existing = set(txt_files)
+        removed = [batch["source_file"] for batch in manifest["batches"] if batch.get("source_file") not in existing]
+        for txt_file in removed:
+            self.logger.info(f"Source file removed: {txt_file}")
+        return removed
+    
+    def _embed_parallel(self, input_path, txt_files, num_workers):
+        """把文件分片交给进程池，每个worker只加载一次模型；结果按文件名合并，与分片方式无关"""
+        num_workers = min(num_workers, len(txt_files))
+        # num_threads（0表示全部核心）由各worker平分，避免多个进程的线程数加起来超过核心数
+        threads_per_worker = max(1, (CONFIG.get("num_threads") or os.cpu_count() or 1) // num_workers)
+        shards = _make_shards(input_path, txt_files, num_workers)
+        self.logger.info(f"Embedding {len(txt_files)} files with {num_workers} workers x {threads_per_worker} threads")
+        
+        file_vectors = {}
+        file_chunks = {}
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                 initargs=(threads_per_worker,)) as executor:
+            futures = [executor.submit(_embed_shard, input_path, shard) for shard in shards]
+            for future in as_completed(futures):
+                shard_vectors, shard_chunks = future.result()
+                file_vectors.update(shard_vectors)
+                file_chunks.update(shard_chunks)
+        
+        total_chunks = sum(len(spans) for spans in file_chunks.values())
+        elapsed = time.perf_counter() - start_time
+        self.logger.info(f"Parallel build encoded {total_chunks} chunks in {elapsed:.1f}s ({total_chunks / max(elapsed, 1e-9):.1f} chunks/sec)")
+        return file_vectors, file_chunks
+    
     def _save_embeddings(self, vectors, filename):
         # 创建Faiss索引
         dimension = vectors.shape[1]
@@ -90,28 +443,245 @@ class EmbeddingProcessor:
         
         # 保存索引文件（规范化路径）
         output_dir = CONFIG.get("temp_dir", CONFIG["output_dir"])
+        index_name = _build_file_name(f"{os.path.splitext(filename)[0]}.index", self.build_id)
+        self.batch_files[filename] = index_name
         # 使用normpath确保路径格式正确
-        output_file = os.path.normpath(os.path.join(output_dir, f"{os.path.splitext(filename)[0]}.index"))
+        output_file = os.path.normpath(os.path.join(output_dir, index_name))
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
         # 直接使用系统默认编码处理路径
         faiss.write_index(index, output_file)
         self.logger.info(f"Saved embeddings to {output_file}")
     
+    def _save_merged_index(self, file_vectors, file_chunks, file_hashes):
+        """将所有batch的向量按序号合并为一个索引文件，写出向量id->原文位置映射表，并用manifest.json记录每个batch的向量id范围"""
+        if not file_vectors:
+            self.logger.warning("No embeddings generated, skip merged index")
+            return None
+        
+        # 按文件名中的序号排序，保证合并顺序与向量id确定
+        txt_files = sorted(file_vectors, key=_batch_number)
+        dimension = file_vectors[txt_files[0]].shape[1]
+        
+        batches = []
+        chunk_rows = []
+        current_id = 0
+        for file_id, txt_file in enumerate(txt_files):
+            vectors = file_vectors[txt_file]
+            chunk_rows.extend((file_id,) + span for span in file_chunks[txt_file])
+            batches.append({
+                "file_name": self.batch_files[txt_file],
+                "source_file": txt_file,
+                "sha256": file_hashes[txt_file],
+                "start_id": current_id,
+                "end_id": current_id + len(vectors) - 1,
+                "ntotal": len(vectors)
+            })
+            current_id += len(vectors)
+        
+        # 按index_type / index_encoding构建合并索引（各batch的索引始终是flat，作为增量构建时的向量存储）
+        index_type = CONFIG.get("index_type", "flat")
+        encoding = CONFIG.get("index_encoding", "flat")
+        all_vectors = np.concatenate([file_vectors[f] for f in txt_files])
+        start_time = time.perf_counter()
+        merged_index = build_index(all_vectors, index_type, encoding)
+        self.logger.info(f"Built {index_type}/{encoding} merged index in {time.perf_counter() - start_time:.1f}s")
+        
+        output_dir = CONFIG.get("temp_dir", CONFIG["output_dir"])
+        os.makedirs(output_dir, exist_ok=True)
+        merged_name = _build_file_name(CONFIG.get("merged_index_name", "merged.index"), self.build_id)
+        merged_path = os.path.normpath(os.path.join(output_dir, merged_name))
+        faiss.write_index(merged_index, merged_path)
+        
+        # 有损编码时另存一份float32全精度向量（查询时以内存映射方式读取，只用于候选的精确重排）
+        vector_store_name = None
+        if encoding != "flat":
+            vector_store_name = _build_file_name(CONFIG.get("vector_store_name", "vectors.npy"), self.build_id)
+            np.save(os.path.join(output_dir, vector_store_name), all_vectors)
+        del all_vectors
+        bytes_per_vector = os.path.getsize(merged_path) / max(current_id, 1)
+        self.logger.info(f"Memory report: merged index {bytes_per_vector:.1f} bytes/vector "
+                         f"({os.path.getsize(merged_path) / 2**20:.1f} MiB, float32 would be {dimension * 4} bytes/vector)"
+                         + (f", full-precision store {dimension * 4} bytes/vector on disk (memory-mapped)" if vector_store_name else ""))
+        
+        chunk_table_name = _build_file_name(CONFIG.get("chunk_table_name", "chunk_table.npy"), self.build_id)
+        np.save(os.path.join(output_dir, chunk_table_name), np.array(chunk_rows, dtype=CHUNK_DTYPE))
+        
+        # 按向量id顺序读出所有文本块，写出段落库，再构建BM25字二元组倒排索引（文档编号即向量id）
+        texts = self._read_chunk_texts(txt_files, chunk_rows)
+        passages_name = _build_file_name(CONFIG.get("passages_name", "passages.bin"), self.build_id)
+        passage_offsets_name = _build_file_name(CONFIG.get("passage_offsets_name", "passage_offsets.npy"), self.build_id)
+        self._save_passage_store(texts, os.path.join(output_dir, passages_name), os.path.join(output_dir, passage_offsets_name))
+        bm25_name = _build_file_name(CONFIG.get("bm25_name", "bm25.npz"), self.build_id)
+        self._save_bm25_index(texts, os.path.join(output_dir, bm25_name))
+        
+        manifest = {
+            "build_id": self.build_id,
+            "model_name": CONFIG["model_name"],
+            "dimension": dimension,
+            "ntotal": current_id,
+            "index_file": merged_name,
+            "index_type": index_type,
+            "index_settings": _index_settings(),
+            "bytes_per_vector": round(bytes_per_vector, 2),
+            "vector_store": vector_store_name,
+            "chunk_table": chunk_table_name,
+            "bm25_index": bm25_name,
+            "passages": passages_name,
+            "passage_offsets": passage_offsets_name,
+            "settings": _build_settings(),
+            "batches": batches
+        }
+        manifest_path = os.path.join(output_dir, CONFIG.get("manifest_name", "manifest.json"))
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        self.logger.info(f"Saved merged index ({current_id} vectors) and manifest to {output_dir}")
+        return merged_index
+    
+    def _read_chunk_texts(self, txt_files, chunk_rows):
+        """按映射表中的字节偏移读出每个文本块（未变化的文件也要读，段落库和BM25都需要全部文本）"""
+        input_path = CONFIG["input_dir"]
+        texts = []
+        current_file_id = None
+        data = b""
+        for file_id, _, _, byte_start, byte_end in chunk_rows:
+            if file_id != current_file_id:
+                with open(os.path.join(input_path, txt_files[file_id]), 'rb') as f:
+                    data = f.read()
+                current_file_id = file_id
+            texts.append(data[byte_start:byte_end].decode('utf-8', errors='ignore').lstrip('\ufeff'))
+        return texts
+    
+    def _save_passage_store(self, texts, passages_path, offsets_path):
+        """
+        把所有文本块按向量id顺序拼接成一个UTF-8文件，第i个文本块为passages[offsets[i]:offsets[i+1]]
+        
+        检索时内存映射这个文件，取段落只需按偏移切片，不再逐个打开txt文件
+        """
+        encoded = [text.encode('utf-8') for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        # 两个文件都先写临时文件名再替换，中途中断不会留下新偏移配旧段落库（或反过来）
+        passages_temp = f"{passages_path}.{os.getpid()}.tmp"
+        offsets_temp = f"{offsets_path}.{os.getpid()}.tmp"
+        with open(passages_temp, 'wb') as f:
+            for data in encoded:
+                f.write(data)
+        with open(offsets_temp, 'wb') as f:
+            np.save(f, offsets)
+        os.replace(passages_temp, passages_path)
+        os.replace(offsets_temp, offsets_path)
+        self.logger.info(f"Saved passage store ({len(encoded)} passages, {offsets[-1] / 2**20:.1f} MiB)")
+    
+    def _save_bm25_index(self, texts, bm25_path):
+        """构建BM25索引（未变化的文件也需要参与统计词频，因此每次都全部重建）"""
+        start_time = time.perf_counter()
+        bm25 = BM25Index.build(texts, CONFIG.get("bm25_k1", 1.2), CONFIG.get("bm25_b", 0.75))
+        bm25.save(bm25_path)
+        self.logger.info(f"Saved BM25 index ({len(bm25.terms)} terms, {len(bm25.doc_ids)} postings) "
+                         f"in {time.perf_counter() - start_time:.1f}s")
+    
+    def _save_topic_gate(self, merged_index):
+        """
+        用配置中的相关/无关问题校准话题判断阈值，写出topic_gate.json
+        
+        分数不低于high判为相关，低于low判为无关，两者之间为不确定区间（由调用方决定是否交给LLM判断）。
+        两组问题分数不重叠时，区间取两组之间的空隙；重叠时取重叠部分。
+        
+        返回:
+            bool: 是否在临时目录中写出了topic_gate.json（话题判断关闭时为False）
+        """
+        positives = CONFIG.get("topic_gate_positive") or []
+        negatives = CONFIG.get("topic_gate_negative") or []
+        if not _topic_gate_enabled():
+            if not positives or not negatives:
+                self.logger.warning("No calibration questions configured, skip topic gate")
+            else:
+                self.logger.warning("Topic gate requires normalized embeddings, skip topic gate")
+            # 删除上次构建留下的阈值，检索器不再使用与当前配置不符的话题判断
+            gate_path = os.path.join(CONFIG["output_dir"], CONFIG.get("topic_gate_name", "topic_gate.json"))
+            if os.path.exists(gate_path):
+                os.remove(gate_path)
+                self.logger.info(f"Removed stale topic gate: {gate_path}")
+            return False
+        
+        self._load_model()
+        k = CONFIG.get("topic_gate_k", 5)
+        vectors = _encode_texts(self.tokenizer, self.model, positives + negatives, self.logger)
+        # 用检索器运行时的nprobe / efSearch搜索，阈值与运行时的分数分布一致
+        apply_search_params(merged_index, CONFIG.get("index_type", "flat"), CONFIG)
+        scores = _topic_scores(merged_index, vectors, k)
+        positive_scores = scores[:len(positives)]
+        negative_scores = scores[len(positives):]
+        
+        # 用分位数而不是极值，避免个别校准问题把区间拉得过宽
+        positive_low = float(np.percentile(positive_scores, 10))
+        negative_high = float(np.percentile(negative_scores, 90))
+        low, high = min(positive_low, negative_high), max(positive_low, negative_high)
+        gate = {
+            "model_name": CONFIG["model_name"],
+            "k": k,
+            "low": low,
+            "high": high,
+            "threshold": (low + high) / 2,
+            "positive_scores": [round(float(x), 4) for x in positive_scores],
+            "negative_scores": [round(float(x), 4) for x in negative_scores],
+            "settings_hash": _topic_gate_settings(),
+        }
+        
+        output_dir = CONFIG.get("temp_dir", CONFIG["output_dir"])
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, CONFIG.get("topic_gate_name", "topic_gate.json")), 'w', encoding='utf-8') as f:
+            json.dump(gate, f, ensure_ascii=False, indent=2)
+        self.logger.info(f"Saved topic gate: low={low:.4f}, high={high:.4f} "
+                         f"(positive p10={positive_low:.4f}, negative p90={negative_high:.4f})")
+        return True
+    
     def _move_files(self):
-        """将临时目录中的文件移回输出目录并清理临时文件"""
+        """
+        将临时目录中的构建结果发布到输出目录并清理临时文件
+        
+        数据文件名都带本次的构建编号，不会覆盖检索器正在映射的旧文件，直接移动到输出目录即可；
+        固定文件名的topic_gate.json和manifest.json先移动为临时文件名，再用os.replace原子替换，
+        manifest最后替换。替换manifest是切换到新构建的唯一一步：在此之前失败，manifest和它引用的
+        文件都还是上一次构建的；新构建多出的文件没有被引用，由下次构建清理
+        """
         temp_dir = CONFIG["temp_dir"]
         output_dir = CONFIG["output_dir"]
+        manifest_name = CONFIG.get("manifest_name", "manifest.json")
+        topic_gate_name = CONFIG.get("topic_gate_name", "topic_gate.json")
         
         # 确保输出目录存在
         os.makedirs(output_dir, exist_ok=True)
+        if not os.path.exists(temp_dir):
+            self.logger.info("Nothing to publish, temporary directory does not exist")
+            return
+        previous_manifest = self._read_manifest()
         
-        # 移动所有.index文件
-        for filename in os.listdir(temp_dir):
-            if filename.endswith(".index"):
-                src_path = os.path.join(temp_dir, filename)
+        filenames = os.listdir(temp_dir)
+        data_files = sorted(f for f in filenames if f.endswith((".index", ".npy", ".npz", ".bin")))
+        # 话题判断文件在前，manifest排在最后
+        fixed_files = [f for f in (topic_gate_name, manifest_name) if f in filenames]
+        staged = []
+        try:
+            for filename in data_files:
                 dst_path = os.path.join(output_dir, filename)
-                shutil.move(src_path, dst_path)
+                shutil.move(os.path.join(temp_dir, filename), dst_path)
+                self.logger.info(f"Moved file to output directory: {dst_path}")
+            for filename in fixed_files:
+                staging_path = os.path.join(output_dir, f"{filename}.{os.getpid()}.tmp")
+                shutil.move(os.path.join(temp_dir, filename), staging_path)
+                staged.append((staging_path, os.path.join(output_dir, filename)))
+            for staging_path, dst_path in staged:
+                os.replace(staging_path, dst_path)
                 self.logger.info(f"Moved file to output directory: {dst_path}")
+        except OSError:
+            # 未替换的临时文件删掉；manifest没有替换时仍指向上一次构建的完整文件
+            for staging_path, _ in staged:
+                if os.path.exists(staging_path):
+                    os.remove(staging_path)
+            raise
+        
+        self._remove_unreferenced(previous_manifest)
                 
         # 删除空的临时目录
         if os.path.exists(temp_dir):
@@ -120,6 +690,24 @@ class EmbeddingProcessor:
                 self.logger.info(f"Removed temporary directory: {temp_dir}")
             except OSError:
                 self.logger.warning(f"Failed to remove temporary directory: {temp_dir} (可能非空)")
+    
+    def _remove_unreferenced(self, previous_manifest):
+        """
+        删除输出目录中当前和上一次manifest都没有引用的数据文件
+        
+        保留上一次构建，刚读到旧manifest的检索器仍能打开它引用的文件；
+        文件仍被占用（Windows下正在映射）时跳过，下次构建再删除
+        """
+        output_dir = CONFIG["output_dir"]
+        keep = _manifest_files(self._read_manifest()) | _manifest_files(previous_manifest)
+        for filename in os.listdir(output_dir):
+            if not filename.endswith((".index", ".npy", ".npz", ".bin")) or filename in keep:
+                continue
+            try:
+                os.remove(os.path.join(output_dir, filename))
+                self.logger.info(f"Removed unreferenced file: {filename}")
+            except OSError as e:
+                self.logger.warning(f"Failed to remove unreferenced file: {filename} ({e})")
 
 if __name__ == "__main__":
     processor = EmbeddingProcessor()
@@ -0,0 +1,13 @@
+import faiss
+
+def apply_search_params(index, index_type, config):
+    """
+    按配置设置IVF的nprobe和HNSW的efSearch
+
+    这两个搜索参数不随索引保存，新建或读入的索引都是faiss默认值（nprobe=1, efSearch=16）；
+    构建时校准话题判断和检索器加载索引都调用这里，保证两边的分数来自同样的搜索方式
+    """
+    if index_type == "ivf":
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", config.get("ivf_nprobe", 8))
+    elif index_type == "hnsw":
+        faiss.ParameterSpace().set_index_parameter(index, "efSearch", config.get("hnsw_ef_search", 64))
@@ -1,8 +1,18 @@
 import torch
 import os
+import re
+import sys
+import mmap
+import shutil
+import atexit
+import tempfile
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
 import yaml
 import json  # 添加json模块用于元数据处理
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, AutoModelForSequenceClassification
 import faiss
 import numpy as np
 
@@ -16,31 +26,341 @@ with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
     CONFIG = yaml.safe_load(f)
     CONFIG["output_dir"] = CONFIG.get("output_dir", "").replace("\\", "/")
 
+# BM25倒排索引、分句规则、批量编码和索引搜索参数的实现与构建脚本共用
+sys.path.append(os.path.join(BASE_DIR, "embedding"))
+from bm25 import BM25Index
+from chunking import SENTENCE_PATTERN
+from encoder import batched_forward, encode_cls
+from search_params import apply_search_params
+
+class QueryEmbeddingCache:
+    """
+    查询向量的LRU缓存，键为(模型名, 规范化后的文本)
+    
+    设置path时同时持久化到SQLite文件，重启后热门查询仍可直接命中
+    """
+    def __init__(self, model_name, max_size=1024, path=None):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embedding ("
+                "model TEXT, text TEXT, vector BLOB, PRIMARY KEY (model, text))"
+            )
+            self._db.commit()
+    
+    @staticmethod
+    def normalize(text):
+        """统一全半角并合并空白，使仅有格式差异的查询命中同一条缓存"""
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+    
+    def get(self, text):
+        key = self.normalize(text)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT vector FROM query_embedding WHERE model = ? AND text = ?",
+                    (self.model_name, key)
+                ).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype=np.float32).reshape(1, -1)
+                    self._put_memory(key, vector)
+                    self.hits += 1
+                    return vector
+            self.misses += 1
+            return None
+    
+    def put(self, text, vector):
+        key = self.normalize(text)
+        vector = np.ascontiguousarray(vector, dtype=np.float32)
+        with self._lock:
+            self._put_memory(key, vector)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_embedding (model, text, vector) VALUES (?, ?, ?)",
+                    (self.model_name, key, vector.tobytes())
+                )
+                self._db.commit()
+    
+    def _put_memory(self, key, vector):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def stats(self):
+        """返回命中/未命中次数和当前内存中的条目数"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries)
+            }
+    
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class CrossEncoderReranker:
+    """
+    交叉编码器重排（bge-reranker等）：把(问题, 段落)成对输入模型，直接输出相关性分数
+
+    比向量距离更准但每对都要一次前向计算，因此只对检索出的少量候选打分。
+    候选按token长度排序后分批计算以减少padding；分数按(问题, 段落)缓存在LRU中，
+    渐进式查询和重复提问时不必重复计算
+    """
+    def __init__(self, model_name, device="cpu", batch_size=16, max_length=512, cache_size=4096):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).to(device)
+        self.model.eval()
+        self.device = device
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def score(self, question, texts):
+        """返回每个段落与问题的相关性分数（越大越相关），顺序与texts一致"""
+        query = QueryEmbeddingCache.normalize(question)
+        scores = np.empty(len(texts), dtype=np.float32)
+        missing = []
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = (query, text)
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    scores[i] = self._scores[key]
+                else:
+                    missing.append(i)
+            if not missing:
+                return scores
+
+            # tokenizer（fast版本）不支持多线程同时调用，打分过程串行执行
+            encodings = self.tokenizer([query] * len(missing), [texts[i] for i in missing],
+                                       truncation="only_second", max_length=self.max_length)
+            scores[missing] = batched_forward(
+                self.tokenizer, encodings, self.batch_size, self.device,
+                lambda inputs: self.model(**inputs).logits.view(-1).float().cpu().numpy(),
+                np.empty(len(missing), dtype=np.float32))
+
+            for i in missing:
+                self._scores[(query, texts[i])] = float(scores[i])
+            while len(self._scores) > self.cache_size:
+                self._scores.popitem(last=False)
+        return scores
+
+
+class RetrievalSession:
+    """
+    一次检索会话：只按最大数量搜索一次，之后按排名顺序分批交出尚未用过的段落
+    
+    渐进式查询每一轮只需要处理新增的段落，不必重新搜索和重复发送已看过的文本
+    """
+    def __init__(self, passages):
+        self.passages = passages
+        self._cursor = 0
+    
+    def next(self, n):
+        """取出接下来排名最高的n个未使用段落（不足n个时返回剩余的全部）"""
+        batch = self.passages[self._cursor:self._cursor + n]
+        self._cursor += len(batch)
+        return batch
+    
+    @property
+    def seen(self):
+        """已经交出的段落"""
+        return self.passages[:self._cursor]
+    
+    @property
+    def exhausted(self):
+        return self._cursor >= len(self.passages)
+
+
 class HarryPotterAgent:
     def __init__(self):
         self.device = CONFIG.get("device", "cpu")
         self.model_name = CONFIG.get("model_name", "bert-base-uncased")
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
         self.model = AutoModel.from_pretrained(self.model_name).to(self.device)
+        self.model.eval()
+        # tokenizer（fast版本）不支持多线程同时调用，编码过程需要串行
+        self._encode_lock = threading.Lock()
+        self.query_cache = QueryEmbeddingCache(
+            self.model_name,
+            max_size=CONFIG.get("query_cache_size", 1024),
+            path=CONFIG.get("query_cache_path") or None
+        )
+        self.chunk_table = None
+        self.bm25 = None
+        self.vector_store = None
+        self.passages = None
+        self.passage_offsets = None
+        # 本进程复制索引文件用的临时目录（每个进程各自一份，close时删除）
+        self._temp_dir = None
         self.index = self._load_index()
+        self.topic_gate = self._load_topic_gate()
+        self.reranker = None
+        if CONFIG.get("reranker_enabled", False):
+            self.reranker = CrossEncoderReranker(
+                CONFIG.get("reranker_model", "BAAI/bge-reranker-base"),
+                device=self.device,
+                batch_size=CONFIG.get("reranker_batch_size", 16),
+                max_length=CONFIG.get("reranker_max_length", 512),
+                cache_size=CONFIG.get("reranker_cache_size", 4096)
+            )
     
     def _load_index(self):
+        """优先以内存映射方式打开预先合并好的索引；不存在时退回逐个合并batch_*.index"""
+        manifest_path = os.path.join(CONFIG["output_dir"], CONFIG.get("manifest_name", "manifest.json"))
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            merged_path = os.path.join(CONFIG["output_dir"], manifest["index_file"])
+            if os.path.exists(merged_path):
+                self.batch_info = [
+                    {
+                        "start_id": batch["start_id"],
+                        "end_id": batch["end_id"],
+                        "file_name": batch["file_name"],
+                        "source_file": batch.get("source_file"),
+                        "file_index": file_index
+                    }
+                    for file_index, batch in enumerate(manifest["batches"])
+                ]
+                # 向量id -> (文件, 行号, 字节偏移) 映射表，检索时只取命中的段落
+                chunk_table_path = os.path.join(CONFIG["output_dir"], manifest.get("chunk_table", ""))
+                if manifest.get("chunk_table") and os.path.exists(chunk_table_path):
+                    self.chunk_table = np.load(chunk_table_path, mmap_mode='r')
+                # 按向量id拼接的段落库：整个文件只映射一次，取段落时按偏移切片后解码
+                passages_path = os.path.join(CONFIG["output_dir"], manifest.get("passages") or "")
+                offsets_path = os.path.join(CONFIG["output_dir"], manifest.get("passage_offsets") or "")
+                if manifest.get("passages") and os.path.exists(passages_path) and os.path.exists(offsets_path):
+                    offsets = np.load(offsets_path, mmap_mode='r')
+                    if offsets[-1] > 0:
+                        with open(passages_path, 'rb') as f:
+                            passages = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        # 偏移表的终点必须等于段落库大小，否则两者来自不同的构建，切片会静默取错文本，此时退回按字节偏移读原文件
+                        if len(passages) == int(offsets[-1]):
+                            self.passages = passages
+                            self.passage_offsets = offsets
+                        else:
+                            print(f"\033[93m警告：段落库大小与偏移表不一致（{len(passages)} != {int(offsets[-1])}），"
+                                  f"将直接读取原文件，请重新运行processor.py\033[0m")
+                            passages.close()
+                # 字二元组BM25倒排索引（文档编号与向量id一致），用于混合检索
+                bm25_path = os.path.join(CONFIG["output_dir"], manifest.get("bm25_index", ""))
+                if self.chunk_table is not None and manifest.get("bm25_index") and os.path.exists(bm25_path):
+                    self.bm25 = BM25Index.load(bm25_path)
+                # 有损编码索引对应的float32全精度向量，只读内存映射，精确重排时按需读取
+                vector_store_path = os.path.join(CONFIG["output_dir"], manifest.get("vector_store") or "")
+                if manifest.get("vector_store") and os.path.exists(vector_store_path):
+                    self.vector_store = np.load(vector_store_path, mmap_mode='r')
+                index_type = manifest.get("index_type", "flat")
+                self.global_index = self._read_index_mmap(merged_path, index_type)
+                self._apply_search_params(self.global_index, index_type)
+                self._check_counts(manifest.get("ntotal", self.global_index.ntotal))
+                return self.global_index
+        return self._load_batch_indexes()
+    
+    def _check_counts(self, ntotal):
+        """
+        检查manifest引用的各文件条数一致（都等于向量总数）
+        
+        条数不同说明文件来自不同的构建，向量id会错位并静默返回错误的段落：
+        合并索引和映射表不一致时拒绝加载；BM25、段落库和全精度向量不一致时只停用该部分
+        """
+        if self.global_index.ntotal != ntotal or (self.chunk_table is not None and len(self.chunk_table) != ntotal):
+            raise RuntimeError(f"合并索引（{self.global_index.ntotal}）、映射表"
+                               f"（{len(self.chunk_table) if self.chunk_table is not None else '-'}）与manifest（{ntotal}）"
+                               f"的向量数不一致，请重新运行processor.py")
+        if self.bm25 is not None and self.bm25.num_docs != ntotal:
+            print(f"\033[93m警告：BM25索引的文档数与manifest不一致（{self.bm25.num_docs} != {ntotal}），将只使用向量检索\033[0m")
+            self.bm25 = None
+        if self.passage_offsets is not None and len(self.passage_offsets) - 1 != ntotal:
+            print(f"\033[93m警告：段落库的段落数与manifest不一致（{len(self.passage_offsets) - 1} != {ntotal}），将直接读取原文件\033[0m")
+            self.passages.close()
+            self.passages = None
+            self.passage_offsets = None
+        if self.vector_store is not None and len(self.vector_store) != ntotal:
+            print(f"\033[93m警告：全精度向量数与manifest不一致（{len(self.vector_store)} != {ntotal}），将不做精确重排\033[0m")
+            self.vector_store = None
+    
+    def _load_topic_gate(self):
+        """读取构建时校准好的话题判断阈值，不存在或模型不一致时返回None"""
+        gate_path = os.path.join(CONFIG["output_dir"], CONFIG.get("topic_gate_name", "topic_gate.json"))
+        if not os.path.exists(gate_path):
+            return None
+        with open(gate_path, 'r', encoding='utf-8') as f:
+            gate = json.load(f)
+        if gate.get("model_name") != self.model_name:
+            return None
+        return gate
+    
+    def _apply_search_params(self, index, index_type):
+        """IVF和HNSW索引的搜索参数不随索引保存，加载后按配置设置（与构建时校准话题判断的设置一致）"""
+        apply_search_params(index, index_type, CONFIG)
+    
+    def _make_temp_dir(self):
+        """
+        创建本进程专用的临时目录
+
+        不能用配置中的temp_dir：构建脚本会在其中暂存产物并在结束时整个删除，
+        多个检索进程共用时也会互相覆盖或删除正在映射的文件
+        """
+        if self._temp_dir is None:
+            self._temp_dir = tempfile.mkdtemp(prefix="harrypotter_index_")
+        return self._temp_dir
+    
+    def _read_index_mmap(self, index_path, index_type="flat"):
+        """以只读内存映射方式读取索引，多个进程可共享同一份页缓存"""
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        # IVF的倒排表由IO_FLAG_MMAP映射，整个文件映射（IFC）与之不兼容
+        if index_type != "ivf":
+            flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        try:
+            return faiss.read_index(index_path, flags)
+        except RuntimeError:
+            # 路径含中文时faiss可能无法打开，只需把这一个文件复制到本进程的临时目录（映射期间不能删除，close时删除）
+            temp_path = os.path.join(self._make_temp_dir(), os.path.basename(index_path))
+            shutil.copy2(index_path, temp_path)
+            return faiss.read_index(temp_path, flags)
+    
+    def _load_batch_indexes(self):
         """加载所有batch_*.index文件并合并为全局索引"""
-        import shutil
         index_dir = CONFIG["output_dir"]
-        temp_dir = CONFIG["temp_dir"]
+        # 本进程专用的临时目录，合并完成后删除，不影响构建脚本和其他进程
+        temp_dir = tempfile.mkdtemp(prefix="harrypotter_batches_")
         
-        # 创建temp_dir目录
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # 获取所有batch_*.index文件
-        index_files = [f for f in os.listdir(index_dir) if f.startswith("batch_") and f.endswith(".index")]
+        # 有manifest时按其中的顺序取本次构建的batch索引（文件名带构建编号，目录中可能还有上一次构建的文件）
+        manifest_path = os.path.join(index_dir, CONFIG.get("manifest_name", "manifest.json"))
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                index_files = [batch["file_name"] for batch in json.load(f)["batches"]]
+        else:
+            # 获取所有batch_*.index文件
+            index_files = [f for f in os.listdir(index_dir) if f.startswith("batch_") and f.endswith(".index")]
+            # 按文件名中的序号排序（batch_0.index, batch_1.index...）
+            index_files.sort(key=lambda x: int(x.split("_")[1].split(".")[0]))
         if not index_files:
             raise FileNotFoundError(f"未找到batch索引文件: {index_dir}")
         
-        # 按文件名中的序号排序（batch_0.index, batch_1.index...）
-        index_files.sort(key=lambda x: int(x.split("_")[1].split(".")[0]))
-        
         # 将索引文件复制到temp_dir
         temp_files = []
         for file_name in index_files:
@@ -51,6 +371,7 @@ class HarryPotterAgent:
         
         # 初始化全局索引和batch信息
         self.global_index = None
+        self.chunk_table = None
         self.batch_info = []
         current_id = 0
         
@@ -76,31 +397,44 @@ class HarryPotterAgent:
             
             current_id += index.ntotal
         
-        # 删除temp_dir中的临时文件
-        import shutil
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        # 删除临时目录
+        shutil.rmtree(temp_dir, ignore_errors=True)
         
         return self.global_index
     
     def _generate_embedding(self, text):
         """生成输入文本的嵌入向量"""
-        inputs = self.tokenizer(
-            text,
-            padding=True,
-            truncation=True,
-            max_length=CONFIG.get("max_length", 512),
-            return_tensors='pt'
-        ).to(self.device)
-        
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            embedding = outputs.last_hidden_state[:, 0].cpu().numpy()
-            if CONFIG.get("normalize", True):
-                embedding = embedding / np.linalg.norm(embedding, axis=1, keepdims=True)
+        with self._encode_lock:
+            inputs = self.tokenizer(
+                text,
+                padding=True,
+                truncation=True,
+                max_length=CONFIG.get("max_length", 512),
+                return_tensors='pt'
+            ).to(self.device)
+            
+            with torch.no_grad():
+                outputs = self.model(**inputs)
+                embedding = outputs.last_hidden_state[:, 0].cpu().numpy()
+        if CONFIG.get("normalize", True):
+            embedding = embedding / np.linalg.norm(embedding, axis=1, keepdims=True)
         
         return embedding
     
+    def _encode_texts(self, texts):
+        """批量编码多段文本（按token长度排序分批以减少padding），返回行顺序与texts一致的向量矩阵"""
+        with self._encode_lock:
+            return encode_cls(self.tokenizer, self.model, texts, CONFIG.get("max_length", 512),
+                              CONFIG.get("encode_batch_size", 32), self.device, CONFIG.get("normalize", True))
+    
+    def _embed_query(self, question):
+        """生成查询向量，相同的查询直接从缓存中取"""
+        embedding = self.query_cache.get(question)
+        if embedding is None:
+            embedding = self._generate_embedding(question).astype(np.float32)
+            self.query_cache.put(question, embedding)
+        return embedding
+    
     def get_top_k_files(self, question, k=3):
         """
         根据问题获取最相关的k个文件路径
@@ -113,17 +447,17 @@ class HarryPotterAgent:
             list: 包含匹配文件路径的列表，格式为[文件路径1, 文件路径2, 文件路径3]
         """
         # 生成问题的嵌入向量
-        question_embedding = self._generate_embedding(question)
+        question_embedding = self._embed_query(question)
         
         # 执行Faiss搜索
-        distances, indices = self.index.search(question_embedding, k)
+        distances, indices = self._search(question_embedding, k)
         
         # 解析结果并生成文件路径列表
         file_paths = []
         for idx in indices[0]:
-            if idx < len(self.batch_info):
-                file_name = self.batch_info[idx]["file_name"]
-                file_path = os.path.join(CONFIG["output_dir"], file_name).replace("\\", "/")
+            batch = self._batch_of(idx)
+            if batch is not None:
+                file_path = os.path.join(CONFIG["output_dir"], batch["file_name"]).replace("\\", "/")
                 file_paths.append(file_path)
             else:
                 file_paths.append("unknown")
@@ -143,36 +477,257 @@ class HarryPotterAgent:
             list: 包含匹配批次信息的列表，格式为[(文件路径, 距离)]
         """
         # 生成问题的嵌入向量
-        question_embedding = self._generate_embedding(question)
+        question_embedding = self._embed_query(question)
         
         # 执行Faiss搜索
-        distances, indices = self.index.search(question_embedding, top_batches)
+        distances, indices = self._search(question_embedding, top_batches)
         
-        # 解析结果（使用batch_info中的文件名信息）
+        # 解析结果（按向量id所在的id范围找到对应的batch文件）
         results = []
         for i, idx in enumerate(indices[0]):
-            # 使用batch_info中的文件名信息构建路径
-            # 确保idx在有效范围内
-            idx = idx % len(self.batch_info) if len(self.batch_info) > 0 else 0
-            
-            if idx < len(self.batch_info):
-                file_name = self.batch_info[idx]["file_name"]
-                # 将索引文件路径替换为txt_batches中的txt文件
-                txt_file = file_name.replace('.index', '.txt')
-                file_path = os.path.join(BASE_DIR, "txt_batches", txt_file).replace("\\", "/")
-            else:
-                # 默认使用第一个batch的信息
-                file_name = self.batch_info[0]["file_name"]
-                txt_file = file_name.replace('.index', '.txt')
-                file_path = os.path.join(BASE_DIR, "txt_batches", txt_file).replace("\\", "/")
-                
+            batch = self._batch_of(idx)
+            if batch is None:
+                continue
             # 只保留文件路径和距离
-            results.append((file_path, distances[0][i]))
+            results.append((self._txt_path(batch), distances[0][i]))
         
         # 按距离从小到大排序
         results.sort(key=lambda x: x[1])
         return results
     
+    def find_relevant_passages(self, question, top_k=3):
+        """
+        查找与问题最相关的段落（只返回命中的文本块，而不是整个batch文件）
+        
+        search_mode为hybrid且存在BM25索引时，融合向量检索和关键词检索的排名；
+        启用交叉编码器重排时先取reranker_candidates个候选，按重排分数取前top_k个
+        
+        参数:
+            question (str): 用户的问题
+            top_k (int): 需要返回的段落数量
+            
+        返回:
+            list: 按相关程度从高到低排列的段落信息，每项为字典
+                {"file_path", "line_start", "line_end", "distance", "rerank_score", "text"}
+                （混合检索中只被BM25命中的段落distance为None，未重排时rerank_score为None）
+        """
+        if self.chunk_table is None:
+            # 没有映射表的旧索引只能返回整个文件
+            return [
+                {"file_path": file_path, "line_start": None, "line_end": None,
+                 "distance": distance, "text": self._read_file(file_path)}
+                for file_path, distance in self.find_relevant_batches(question, top_k)
+            ]
+        
+        question_embedding = self._embed_query(question)
+        fetch_k = top_k if self.reranker is None else max(top_k, CONFIG.get("reranker_candidates", 30))
+        if self.bm25 is not None and CONFIG.get("search_mode", "dense") == "hybrid":
+            ranked = self._hybrid_search(question, question_embedding, fetch_k)
+        else:
+            distances, indices = self._search(question_embedding, fetch_k)
+            ranked = list(zip(indices[0], distances[0]))
+        
+        passages = []
+        for idx, distance in ranked:
+            if idx < 0 or idx >= len(self.chunk_table):
+                continue
+            row = self.chunk_table[idx]
+            file_path = self._txt_path(self.batch_info[row["file_id"]])
+            passages.append({
+                "file_path": file_path,
+                "line_start": int(row["line_start"]),
+                "line_end": int(row["line_end"]),
+                "distance": None if distance is None else float(distance),
+                "rerank_score": None,
+                "text": self._passage_text(idx, file_path, row)
+            })
+        
+        if self.reranker is not None and passages:
+            scores = self.reranker.score(question, [passage["text"] for passage in passages])
+            for passage, score in zip(passages, scores):
+                passage["rerank_score"] = float(score)
+            # 分数相同时保持原检索顺序
+            passages.sort(key=lambda passage: -passage["rerank_score"])
+        return passages[:top_k]
+    
+    def _search(self, question_embedding, k):
+        """
+        在合并索引中搜索，返回值与faiss的search相同((1, k)距离, (1, k)向量id)
+        
+        索引为有损编码（fp16 / sq8 / pq）且有全精度向量时，先取k*rerank_factor个候选，
+        再用全精度向量重新计算距离并排序，只有候选对应的几行会从磁盘读入内存
+        """
+        if self.vector_store is None or not CONFIG.get("rerank_exact", True):
+            return self.index.search(question_embedding, k)
+        candidates = min(self.index.ntotal, k * CONFIG.get("rerank_factor", 4))
+        _, indices = self.index.search(question_embedding, candidates)
+        ids = indices[0][indices[0] >= 0]
+        vectors = np.asarray(self.vector_store[ids], dtype=np.float32)
+        exact = ((vectors - question_embedding[0]) ** 2).sum(axis=1)
+        order = np.argsort(exact, kind="stable")[:k]
+        
+        # 不足k个时与faiss一样用-1和inf补齐
+        distances = np.full((1, k), np.inf, dtype=np.float32)
+        result_ids = np.full((1, k), -1, dtype=np.int64)
+        distances[0, :len(order)] = exact[order]
+        result_ids[0, :len(order)] = ids[order]
+        return distances, result_ids
+    
+    def _hybrid_search(self, question, question_embedding, top_k):
+        """
+        向量检索与BM25检索各取hybrid_candidates个候选，按排名倒数融合（RRF）后取前top_k个
+        
+        返回:
+            list: [(向量id, 向量距离)]，只被BM25命中的文本块距离为None
+        """
+        candidates = max(top_k, CONFIG.get("hybrid_candidates", 50))
+        rrf_k = CONFIG.get("rrf_k", 60)
+        distances, indices = self._search(question_embedding, candidates)
+        _, lexical_ids = self.bm25.search(question, candidates)
+        
+        fused = {}
+        dense_distance = {}
+        for rank, (idx, distance) in enumerate(zip(indices[0], distances[0])):
+            if idx < 0:
+                continue
+            fused[int(idx)] = fused.get(int(idx), 0.0) + 1.0 / (rrf_k + rank + 1)
+            dense_distance[int(idx)] = float(distance)
+        for rank, idx in enumerate(lexical_ids):
+            fused[int(idx)] = fused.get(int(idx), 0.0) + 1.0 / (rrf_k + rank + 1)
+        
+        ranked = sorted(fused, key=lambda idx: (-fused[idx], idx))[:top_k]
+        return [(idx, dense_distance.get(idx)) for idx in ranked]
+    
+    def topic_score(self, question):
+        """问题与语料最相近的k个文本块的平均余弦相似度（与构建时的校准方式一致）"""
+        question_embedding = self._embed_query(question)
+        # 与构建时的校准一致，直接使用索引返回的距离（不做精确重排）
+        distances, _ = self.index.search(question_embedding, min(self.topic_gate["k"], self.index.ntotal))
+        return float((1.0 - distances[0] / 2.0).mean())
+    
+    def classify_topic(self, question, use_band=True):
+        """
+        本地判断问题是否与哈利波特相关
+        
+        参数:
+            question (str): 用户的问题
+            use_band (bool): 为True时分数落在不确定区间内返回"UNCERTAIN"，否则按区间中点直接判断
+            
+        返回:
+            tuple: ("YES" / "NO" / "UNCERTAIN", 话题分数)；没有话题判断文件时返回("UNCERTAIN", None)
+        """
+        if self.topic_gate is None:
+            return "UNCERTAIN", None
+        score = self.topic_score(question)
+        if score >= self.topic_gate["high"]:
+            return "YES", score
+        if score < self.topic_gate["low"]:
+            return "NO", score
+        if use_band:
+            return "UNCERTAIN", score
+        return ("YES" if score >= self.topic_gate["threshold"] else "NO"), score
+    
+    def compress_passages(self, question, texts, token_budget=None):
+        """
+        本地抽取式压缩：从各段落中选出与问题最相关的句子（代替让LLM挑选相关语句）
+        
+        把所有段落切分为句子后一次性批量编码，按最大边际相关（MMR）依次挑选：
+        每一步选 mmr_lambda * 与问题的相似度 - (1 - mmr_lambda) * 与已选句子的最大相似度 最高的句子，
+        相似度低于compress_min_similarity的句子不选，总token数不超过token_budget
+        
+        参数:
+            question (str): 用户的问题（可附带关键词）
+            texts (list): 段落文本列表
+            token_budget (int): 保留句子的token总数上限，默认为compress_token_budget乘以段落数
+            
+        返回:
+            list: 与texts对应的提取结果，选中的句子按原文顺序排列（同一行的句子相连，不同行换行），没有选中句子的段落为空字符串
+        """
+        if token_budget is None:
+            token_budget = CONFIG.get("compress_token_budget", 200) * len(texts)
+        mmr_lambda = CONFIG.get("compress_mmr_lambda", 0.7)
+        min_similarity = CONFIG.get("compress_min_similarity", 0.4)
+        
+        # (段落序号, 行号, 句子)
+        sentences = []
+        for text_id, text in enumerate(texts):
+            for line_no, line in enumerate(text.split("\n")):
+                for match in SENTENCE_PATTERN.finditer(line.strip()):
+                    sentence = match.group().strip()
+                    if sentence:
+                        sentences.append((text_id, line_no, sentence))
+        if not sentences:
+            return ["" for _ in texts]
+        
+        vectors, lengths = self._encode_texts([sentence for _, _, sentence in sentences])
+        token_counts = [max(1, length - 2) for length in lengths]  # 不计[CLS]和[SEP]
+        relevance = vectors @ self._embed_query(question)[0]
+        
+        selected = []
+        used_tokens = 0
+        # 每个句子与已选句子的最大相似度（还没有已选句子时为0）
+        redundancy = np.zeros(len(sentences), dtype=np.float32)
+        candidates = relevance >= min_similarity
+        while candidates.any():
+            mmr = mmr_lambda * relevance - (1.0 - mmr_lambda) * redundancy
+            best = int(np.argmax(np.where(candidates, mmr, -np.inf)))
+            candidates[best] = False
+            # 放不下的句子跳过，继续尝试更短的句子
+            if used_tokens + token_counts[best] > token_budget:
+                continue
+            selected.append(best)
+            used_tokens += token_counts[best]
+            redundancy = np.maximum(redundancy, vectors @ vectors[best])
+        
+        extractions = [[] for _ in texts]
+        for i in sorted(selected):
+            text_id, line_no, sentence = sentences[i]
+            lines = extractions[text_id]
+            if lines and lines[-1][0] == line_no:
+                lines[-1][1].append(sentence)
+            else:
+                lines.append((line_no, [sentence]))
+        return ["\n".join("".join(parts) for _, parts in lines) for lines in extractions]
+    
+    def open_session(self, question, max_k):
+        """按max_k只搜索一次，返回可分批取用结果的RetrievalSession"""
+        return RetrievalSession(self.find_relevant_passages(question, max_k))
+    
+    def _batch_of(self, idx):
+        """根据全局向量id找到所属的batch信息"""
+        if idx < 0:
+            return None
+        if self.chunk_table is not None and idx < len(self.chunk_table):
+            return self.batch_info[self.chunk_table[idx]["file_id"]]
+        for batch in self.batch_info:
+            if batch["start_id"] <= idx <= batch["end_id"]:
+                return batch
+        return None
+    
+    def _txt_path(self, batch):
+        """batch在txt_batches中对应的原文路径（优先使用manifest记录的源文件名，旧索引按batch_N.index推出batch_N.txt）"""
+        txt_file = batch.get("source_file") or os.path.splitext(batch["file_name"])[0] + ".txt"
+        return os.path.join(BASE_DIR, "txt_batches", txt_file).replace("\\", "/")
+    
+    def _passage_text(self, idx, file_path, row):
+        """从段落库中按偏移切片取出第idx个文本块（切片不复制映射内存，只解码这一段）；没有段落库时读原文件"""
+        if self.passages is None:
+            return self._read_span(file_path, int(row["byte_start"]), int(row["byte_end"]))
+        start, end = int(self.passage_offsets[idx]), int(self.passage_offsets[idx + 1])
+        with memoryview(self.passages)[start:end] as view:
+            return str(view, 'utf-8', 'ignore')
+    
+    def _read_file(self, file_path):
+        with open(file_path, 'r', encoding='utf-8-sig', errors='ignore') as f:
+            return f.read()
+    
+    def _read_span(self, file_path, byte_start, byte_end):
+        """按字节偏移读取文件中的一段文本"""
+        with open(file_path, 'rb') as f:
+            f.seek(byte_start)
+            data = f.read(byte_end - byte_start)
+        return data.decode('utf-8', errors='ignore').lstrip('\ufeff')
+    
     def _load_metadata(self):
         """加载批次元数据文件（批次索引到文件路径的映射）"""
         metadata_path = os.path.join(CONFIG["output_dir"], "batch_metadata.json").replace("\\", "/")
@@ -182,9 +737,57 @@ class HarryPotterAgent:
         with open(metadata_path, 'r', encoding='utf-8') as f:
             return json.load(f)
     
+    def close(self):
+        """释放模型和索引占用的内存"""
+        self.model = None
+        self.tokenizer = None
+        self.reranker = None
+        self.index = None
+        self.global_index = None
+        self.vector_store = None
+        if self.passages is not None:
+            self.passages.close()
+            self.passages = None
+        self.passage_offsets = None
+        self.batch_info = []
+        self.query_cache.close()
+        if self._temp_dir is not None:
+            # 索引释放后才能删除映射的文件（Windows下仍被占用时留给系统临时目录清理）
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = None
+
+
+# ===== 进程级共享的检索器 =====
+# 模型和索引只在第一次使用时加载一次，之后所有调用（包括多线程）都复用同一个实例
+_agent_instance = None
+_agent_lock = threading.Lock()
+
+def warm_up():
+    """预热：加载模型和索引（已加载时直接返回现有实例）"""
+    global _agent_instance
+    if _agent_instance is None:
+        with _agent_lock:
+            if _agent_instance is None:
+                _agent_instance = HarryPotterAgent()
+    return _agent_instance
+
+def get_agent():
+    """获取共享的HarryPotterAgent实例，未加载时自动预热"""
+    return warm_up()
+
+def shutdown():
+    """释放共享实例，下次调用时会重新加载"""
+    global _agent_instance
+    with _agent_lock:
+        if _agent_instance is not None:
+            _agent_instance.close()
+            _agent_instance = None
+
+atexit.register(shutdown)
+
 
 if __name__ == "__main__":
-    agent = HarryPotterAgent()
+    agent = get_agent()
     question = "总结一下哈利波特学习漂浮咒的过程"
     # 测试get_top_k_files方法
     top_files = agent.get_top_k_files(question, 3)
@@ -200,16 +803,23 @@ if __name__ == "__main__":
         print(f"{i}. 文件: {file_path}, 距离: {distance:.4f}")
 
 
+def classify_topic(question, use_band=True):
+    """本地话题判断（毫秒级，复用已加载的模型和索引），返回(判断结果, 话题分数)"""
+    return get_agent().classify_topic(question, use_band)
+
+def compress_passages(question, texts, token_budget=None):
+    """本地抽取式压缩（句子向量 + MMR），返回与texts对应的相关句子"""
+    return get_agent().compress_passages(question, texts, token_budget)
+
+def start_retrieval_session(question, max_k):
+    """开启一次检索会话（一次搜索，多轮按排名取用新段落）"""
+    return get_agent().open_session(question, max_k)
+
 def question_to_context(question, top_batches=3):
     """将问题转换为上下文文本列表"""
-    agent = HarryPotterAgent()  # 创建HarryPotterAgent实例
-    batch_results = agent.find_relevant_batches(question, top_batches)  # 调用新方法
-    file_paths = [result[0] for result in batch_results]  # 提取文件路径
-    contexts = []
-    for path in file_paths:
-        with open(path, 'r', encoding='utf-8-sig', errors='ignore') as f:
-            contexts.append(f.read())
-    return contexts
+    agent = get_agent()  # 复用进程内共享的HarryPotterAgent实例
+    passages = agent.find_relevant_passages(question, top_batches)  # 只取命中的段落
+    return [passage["text"] for passage in passages]
 
 if __name__ == "__main__":
     # 示例使用
@@ -1,6 +1,12 @@
 import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from PyPDF2 import PdfReader
 
+# 每页提取结果的缓存目录（按PDF内容哈希分目录），调整batch页数或重叠页数时不需要重新解析PDF
+PAGE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "page_cache")
+
 def get_user_input():
     try:
         page_length = int(input("请输入单个batch的页数长度（默认11）: ") or "11")
@@ -14,11 +20,76 @@ def create_output_dir(output_path):
     os.makedirs(output_path, exist_ok=True)
     print(f"[调试] 输出目录已创建: {output_path}")
 
-def process_pdf(pdf_path, page_length, overlap_length, output_path):
-    reader = PdfReader(pdf_path)
-    total_pages = len(reader.pages)
+def _pdf_sha256(pdf_path):
+    sha256 = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+# ===== 进程池中每个worker只打开一次PDF =====
+_worker_reader = None
+
+def _init_worker(pdf_path):
+    global _worker_reader
+    _worker_reader = PdfReader(pdf_path)
+
+def _extract_pages(page_nums):
+    return [(page_num, _worker_reader.pages[page_num].extract_text()) for page_num in page_nums]
+
+def extract_pages(pdf_path, num_workers=None):
+    """
+    提取PDF每一页的文本，返回按页码排列的文本列表
+    
+    每页的文本缓存在PAGE_CACHE_DIR/<PDF的sha256>/<页码>.txt中，已缓存的页直接读取，
+    其余页分片交给进程池并行提取；PDF所有页都已缓存时完全不解析PDF
+    """
+    cache_dir = os.path.join(PAGE_CACHE_DIR, _pdf_sha256(pdf_path))
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            total_pages = json.load(f)["total_pages"]
+    else:
+        total_pages = len(PdfReader(pdf_path).pages)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump({"total_pages": total_pages}, f)
     print(f"[调试] 总页数: {total_pages}")
     
+    def page_path(page_num):
+        return os.path.join(cache_dir, f"{page_num:05d}.txt")
+    
+    pages = [None] * total_pages
+    missing = []
+    for page_num in range(total_pages):
+        if os.path.exists(page_path(page_num)):
+            with open(page_path(page_num), 'r', encoding='utf-8') as f:
+                pages[page_num] = f.read()
+        else:
+            missing.append(page_num)
+    print(f"[调试] 已缓存 {total_pages - len(missing)} 页，需要提取 {len(missing)} 页")
+    if not missing:
+        return pages
+    
+    num_workers = max(1, min(num_workers or os.cpu_count() or 1, len(missing)))
+    # 每个worker分到几段连续的页码，段数多于worker数以平衡各页解析耗时的差异
+    chunk_size = max(1, len(missing) // (num_workers * 4))
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(pdf_path,)) as executor:
+        for results in executor.map(_extract_pages, chunks):
+            for page_num, text in results:
+                # 先写临时文件再替换，中途中断也不会留下不完整的缓存页
+                temp_path = page_path(page_num) + ".tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                os.replace(temp_path, page_path(page_num))
+                pages[page_num] = text
+    return pages
+
+def process_pdf(pdf_path, page_length, overlap_length, output_path, num_workers=None):
+    pages = extract_pages(pdf_path, num_workers)
+    total_pages = len(pages)
+    
     batches = []
     start_page = 0
     
@@ -27,22 +98,26 @@ def process_pdf(pdf_path, page_length, overlap_length, output_path):
         batches.append((start_page, end_page))
         print(f"[调试] Batch {len(batches)}: 页码范围 {start_page}-{end_page-1}")
         
-        start_page = end_page - overlap_length
+        if end_page >= total_pages:
+            break
+        # 至少前进一页，避免重叠页数不小于batch页数时死循环
+        start_page = max(end_page - overlap_length, start_page + 1)
     
+    # 只是把缓存的页重新分组，重叠部分的页不会被重复解析
     for i, (start, end) in enumerate(batches, 1):
         output_file = os.path.join(output_path, f"batch_{i}.txt")
         
         with open(output_file, 'w', encoding='utf-8') as f:
             for page_num in range(start, end):
-                text = reader.pages[page_num].extract_text()
-                f.write(text + "\\n\\n")
+                f.write(pages[page_num] + "\\n\\n")
         
         print(f"[调试] 已保存: {output_file}")
 
 def main():
     # 假设PDF文件名为"book.pdf"，需要用户自行替换
     pdf_path = "数据库-哈利波特/book.pdf"
-    output_path = ".aux/数据库-哈利波特/txt_batches"
+    # 原始提取结果放在txt_raw，由txt_batches/去掉多余空行/Corpus_Typo.py清洗后写入txt_batches
+    output_path = ".aux/数据库-哈利波特/txt_raw"
     
     print("[调试] 开始处理PDF文件")
     page_length, overlap_length = get_user_input()
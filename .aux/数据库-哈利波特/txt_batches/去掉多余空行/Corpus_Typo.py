@@ -1,11 +1,9 @@
 import os
 import sys
-import re
 import time
-from openai import OpenAI
+import argparse
 from dotenv import load_dotenv
 load_dotenv()
-import socket
 
 # 添加当前目录到sys.path以支持模块导入
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -13,17 +11,56 @@ sys.path.append(current_dir)
 
 # 导入封装好的函数
 import Find_BaseDir
-import remove_empty_lines
-import fix_line_breaks
+from pipeline import CleaningPipeline, remove_empty_lines, repair_breaks
+from cleaning_runner import run_batches
+from fix_line_breaks import MAX_WORKERS, make_llm_resolver
+
+def default_source_dir():
+    """PDF提取出的原始batch所在目录（pdf_convert_to_txt.py的输出目录，与txt_batches同级的txt_raw）"""
+    return os.getenv('txt_raw_dir', os.path.join(os.path.dirname(Find_BaseDir.find_base_dir()), "txt_raw"))
+
+def clean_corpus(source_dir, output_dir, use_llm=True, max_workers=MAX_WORKERS):
+    """
+    把source_dir中的原始batch文件清洗后写入output_dir
+
+    每个文件只读一次，在内存中依次经过 去空行 -> 修复换行 -> 去空行，再原子写入output_dir，
+    源文件保持不变，重跑得到同样的结果；源文件未变的文件根据检查点日志跳过，
+    output_dir中源目录已没有的batch文件会被删除。source_dir不存在或没有batch文件时抛出FileNotFoundError
+    """
+    resolve = make_llm_resolver() if use_llm else None
+    pipeline = CleaningPipeline([remove_empty_lines, repair_breaks(resolve), remove_empty_lines])
+
+    def process(text):
+        result, timings = pipeline.run(text)
+        return result, "，".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in timings.items())
+
+    # 是否调用LLM会影响结果，两种模式分别记录检查点
+    journal_name = "clean_pipeline.journal.jsonl" if use_llm else "clean_pipeline_local.journal.jsonl"
+    start_time = time.perf_counter()
+    summary = run_batches(source_dir, process, journal_name, max_workers, output_dir=output_dir)
+    print(f"\033[94m清洗完成：\033[0m新处理{summary['done']}个，跳过{summary['skipped']}个，"
+          f"失败{summary['failed']}个，删除多余的旧结果{summary['removed']}个，用时{time.perf_counter() - start_time:.1f}秒")
+    print("\033[94m各步骤累计耗时：\033[0m" + "，".join(f"{name} {seconds:.2f}秒" for name, seconds in pipeline.timings.items()))
+    return summary
 
 if __name__ == "__main__":
-    # 依次执行三个脚本的核心功能
-    print("\033[38;5;208m运行中: Find_BaseDir\033[0m")
-    Find_BaseDir.update_env_file()
-    print("\033[38;5;208m运行中: remove_empty_lines\033[0m")
-    remove_empty_lines.database_RemoveEmptyLines()
-    print("\033[38;5;208m运行中: fix_line_breaks\033[0m")
-    fix_line_breaks.database_FixLineBreaks()
-    print("\033[38;5;208m运行中: remove_empty_lines\033[0m")
-    remove_empty_lines.database_RemoveEmptyLines()
-    print("\033[36m所有处理完成！\033[0m")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="单遍清洗语料：原始batch -> 去空行 -> 修复换行 -> 去空行 -> 输出目录")
+    parser.add_argument("--source", default=default_source_dir(), help="原始batch文件所在目录")
+    parser.add_argument("--output", default=Find_BaseDir.find_base_dir(), help="清洗结果的输出目录（默认txt_batches）")
+    parser.add_argument("--no-llm", action="store_true", help="只用本地规则修复换行，不确定的换行保留")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="同时处理的文件数")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.source) == os.path.abspath(args.output):
+        print("\033[91m输出目录不能与原始文件目录相同\033[0m")
+        sys.exit(1)
+    print(f"\033[38;5;208m运行中: 清洗 {args.source} -> {args.output}\033[0m")
+    try:
+        summary = clean_corpus(args.source, args.output, not args.no_llm, args.workers)
+    except FileNotFoundError as e:
+        print(f"\033[91m{e}\n请先运行pdf_convert_to_txt.py提取原始batch，或用--source指定原始文件目录\033[0m")
+        sys.exit(1)
+    if summary["failed"]:
+        print(f"\033[91m有{summary['failed']}个文件处理失败，重新运行会继续处理这些文件\033[0m")
+        sys.exit(1)
+    print("\033[36m所有处理完成！\033[0m")
@@ -1,10 +1,14 @@
 import os
 import re
 
+def find_base_dir():
+    """txt_batches目录的路径（本脚本所在目录的上一级），只计算路径，不修改任何文件"""
+    script_path = os.path.abspath(__file__)
+    return os.path.dirname(os.path.dirname(script_path))
+
 def update_env_file():
     # 获取脚本自身路径并计算目标路径
-    script_path = os.path.abspath(__file__)
-    txt_base_dir = os.path.dirname(os.path.dirname(script_path))
+    txt_base_dir = find_base_dir()
     
     # 获取脚本所在目录
     script_dir = os.path.dirname(os.path.abspath(__file__))
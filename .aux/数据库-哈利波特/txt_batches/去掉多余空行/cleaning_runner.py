@@ -0,0 +1,172 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def list_batches(base_dir):
+    """按编号返回连续存在的batch_N.txt路径（与原来逐个递增编号、遇到缺失即停止的规则一致）"""
+    paths = []
+    n = 1
+    while os.path.exists(os.path.join(base_dir, f'batch_{n}.txt')):
+        paths.append(os.path.join(base_dir, f'batch_{n}.txt'))
+        n += 1
+    return paths
+
+def remove_orphans(source_dir, output_dir):
+    """
+    删除output_dir中源目录里已没有对应文件的batch_N.txt，返回被删除的文件名
+
+    重新提取后batch数量变少时，多出来的旧结果不再留在输出目录中被当作语料建立索引
+    """
+    existing = {os.path.basename(path) for path in list_batches(source_dir)}
+    removed = []
+    for name in sorted(os.listdir(output_dir)):
+        if re.fullmatch(r"batch_\d+\.txt", name) and name not in existing:
+            os.remove(os.path.join(output_dir, name))
+            removed.append(name)
+    return removed
+
+def atomic_write(path, text):
+    """先写临时文件再替换，中途中断也不会留下写了一半的batch文件"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+class TokenBucket:
+    """
+    令牌桶限速：每秒补充rate个令牌，最多积攒capacity个，每次请求消耗一个令牌
+
+    多个线程共用同一个令牌桶，总请求速率不超过rate（短时间内最多突发capacity个请求）
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，令牌不足时阻塞到补充出令牌为止"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait_seconds = (1.0 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class CheckpointJournal:
+    """
+    已完成文件的检查点日志（每行一条JSON：文件名和文件内容的sha256）
+
+    重跑时文件当前内容的哈希与日志中记录的一致就跳过；文件被重新生成（例如重新从PDF提取）后
+    哈希不同，会重新处理。每条记录写入后立即刷新，进程中途崩溃也不会丢失已完成的记录
+    """
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能留下写了一半的最后一行
+                        continue
+                    self.completed[record["file"]] = record["sha256"]
+
+    def is_done(self, name, text):
+        return self.completed.get(name) == _sha256(text)
+
+    def record(self, name, text):
+        digest = _sha256(text)
+        with self._lock:
+            self.completed[name] = digest
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"file": name, "sha256": digest, "finished_at": time.time()}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def run_batches(base_dir, process, journal_name, max_workers=8, output_dir=None):
+    """
+    用线程池并发处理base_dir下所有batch文件，可中断后续跑
+
+    参数:
+        base_dir (str): batch文件所在目录
+        process (callable): process(文本) -> (处理后的文本, 说明文字)，失败时处理后的文本为None
+        journal_name (str): 检查点日志文件名，不同的清洗步骤使用不同的日志
+        max_workers (int): 同时处理的文件数，实际请求速率由process内部的令牌桶限制
+        output_dir (str): 结果写入的目录；为None时原地写回base_dir。
+            写入其他目录时源文件保持不变，日志（放在output_dir下）记录的是源文件内容的哈希，
+            源文件未变且结果文件存在时跳过；output_dir中没有对应源文件的batch文件会被删除
+
+    返回:
+        dict: {"total", "skipped", "done", "failed", "removed"} 各类文件数
+
+    异常:
+        FileNotFoundError: base_dir不存在或其中没有batch_1.txt
+    """
+    paths = list_batches(base_dir)
+    if not paths:
+        raise FileNotFoundError(f"未找到batch文件（batch_1.txt）: {base_dir}")
+    in_place = output_dir is None
+    if in_place:
+        output_dir = base_dir
+    os.makedirs(output_dir, exist_ok=True)
+    journal = CheckpointJournal(os.path.join(output_dir, journal_name))
+    summary = {"total": len(paths), "skipped": 0, "done": 0, "failed": 0, "removed": 0}
+
+    pending = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        name = os.path.basename(path)
+        if journal.is_done(name, text) and (in_place or os.path.exists(os.path.join(output_dir, name))):
+            summary["skipped"] += 1
+        else:
+            pending.append((path, text))
+    print(f"\033[94m共{len(paths)}个文件，检查点中已完成{summary['skipped']}个，待处理{len(pending)}个\033[0m")
+
+    def handle(path, text):
+        start_time = time.perf_counter()
+        result, message = process(text)
+        if result:
+            name = os.path.basename(path)
+            atomic_write(os.path.join(output_dir, name), result)
+            journal.record(name, result if in_place else text)
+        return result is not None and result != "", message, time.perf_counter() - start_time
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(handle, path, text): path for path, text in pending}
+        for future in as_completed(futures):
+            name = os.path.basename(futures[future])
+            try:
+                ok, message, elapsed = future.result()
+            except Exception as e:
+                ok, message, elapsed = False, str(e), 0.0
+            if ok:
+                summary["done"] += 1
+                print(f"\033[92m已完成：\033[0m{name}（{message}，用时{elapsed:.2f}秒）")
+            else:
+                summary["failed"] += 1
+                print(f"\033[91m处理失败：\033[0m{name}（{message}）")
+
+    if not in_place:
+        for name in remove_orphans(base_dir, output_dir):
+            summary["removed"] += 1
+            print(f"\033[93m已删除：\033[0m{name}（源目录中已没有这个文件）")
+    return summary
@@ -1,36 +1,41 @@
 import os
+import sys
 import time
-from openai import OpenAI
+import random
 from dotenv import load_dotenv
 load_dotenv()
-import socket
 
-def database_FixLineBreaks(base_dir=None):
+# 与聊天程序共用code/http_client.py中的连接池配置和网络状态
+CODE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "..", "code"))
+sys.path.append(CODE_DIR)
+from http_client import make_openai_client, connection_health
+from llm_cache import get_llm_cache
+from line_repair import repair_line_breaks
+from cleaning_runner import TokenBucket, run_batches
+
+# ===== 并发与限速配置（按API配额调整） =====
+MAX_WORKERS = int(os.getenv("CLEAN_MAX_WORKERS", "8"))                 # 同时处理的文件数，与共享连接池的连接数一致
+REQUESTS_PER_SECOND = float(os.getenv("CLEAN_REQUESTS_PER_SECOND", "2"))  # 所有线程合计的API请求速率上限
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0   # 第n次重试前等待 RETRY_BASE_DELAY * 2^(n-1) 秒（带随机抖动），最多RETRY_MAX_DELAY秒
+RETRY_MAX_DELAY = 30.0
+JOURNAL_NAME = "fix_line_breaks.journal.jsonl"
+
+def make_llm_resolver():
+    """
+    创建判断不确定换行的LLM调用函数resolve(片段文本) -> 修复换行后的片段文本（失败时返回None）
+    
+    同一个resolve可以被多个线程共用，所有请求共享一个令牌桶限速
+    """
+    
+    # 初始化API客户端（所有文件共用同一个keep-alive连接池）
+    client = make_openai_client(os.getenv("API_KEY"), "https://dashscope.aliyuncs.com/compatible-mode/v1")
+    # 清洗结果只由输入文本决定，重跑清洗流程时未改动的文本直接使用缓存结果
+    llm_cache = get_llm_cache()
+    rate_limiter = TokenBucket(REQUESTS_PER_SECOND)
     
     def fix_line_breaks(text):
-        """通过API调用清理多余换行符"""
-        
-        # 内部网络检查函数
-        def is_connected_to_Internet(host="8.8.8.8", port=53, timeout=3):
-            try:
-                socket.setdefaulttimeout(timeout)
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect((host, port))
-                s.close()
-                return True
-            except Exception:
-                return False
-                
-        # 配置参数
-        MAX_RETRIES = 3
-        RETRY_DELAY = 2
-        Internet_timeout = 5  # 网络超时时间
-        
-        # 初始化API客户端
-        client = OpenAI(
-            api_key=os.getenv("API_KEY"),
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
+        """通过API调用清理多余换行符（只用于本地规则无法确定的片段）"""
         
         # 系统提示词
         messages = [
@@ -40,20 +45,23 @@ def database_FixLineBreaks(base_dir=None):
         # 添加用户输入
         messages.append({'role': 'user', 'content': text})
         
+        cache_key = llm_cache.make_key("qwen-plus", messages)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         retry_count = 0
         while retry_count < MAX_RETRIES:
             try:
-                # 网络检查循环
-                network_retries = 0
-                while not is_connected_to_Internet():
-                    network_retries += 1
-                    if network_retries > MAX_RETRIES:
-                        retry_count=2
-                        raise Exception(f"网络连接失败，已达到最大重试次数({MAX_RETRIES})")
-                    print(f"\033[93m错误: \033[0m无网络连接。\033[93m正在尝试第 {network_retries}/{MAX_RETRIES} 次重试...\033[0m")
-                    time.sleep(Internet_timeout)
+                # 网络检查：最近的请求连接失败时，等退避时间结束再发下一次请求
+                if not connection_health.is_available():
+                    wait_seconds = connection_health.seconds_until_retry()
+                    print(f"\033[93m错误: \033[0m无网络连接。\033[93m{wait_seconds:.0f} 秒后重试...\033[0m")
+                    time.sleep(wait_seconds)
                 
-                completion = client.chat.completions.create(
+                rate_limiter.acquire()
+                completion = connection_health.call(
+                    client.chat.completions.create,
                     model="qwen-plus",
                     messages=messages,
                     stream=False
@@ -68,45 +76,49 @@ def database_FixLineBreaks(base_dir=None):
                 if response.strip() == "\\n":
                     return None
                 '''
+                llm_cache.put(cache_key, response)
                 return response
                 
             except Exception as e:
-                print(f"\033[93m错误: \033[0m{str(e)}。\033[93m第 {retry_count + 1}/{MAX_RETRIES} 次重试...\033[0m")
                 retry_count += 1
-                time.sleep(RETRY_DELAY)
+                # 指数退避加随机抖动，避免并发的线程在同一时刻一起重试（限流错误同样按此退避）
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (retry_count - 1)) * random.uniform(0.5, 1.0)
+                print(f"\033[93m错误: \033[0m{str(e)}。\033[93m{delay:.1f} 秒后第 {retry_count}/{MAX_RETRIES} 次重试...\033[0m")
+                time.sleep(delay)
                 
         return None
+    
+    return fix_line_breaks
+
+def database_FixLineBreaks(base_dir=None, use_llm=True, max_workers=MAX_WORKERS):
+    """
+    修复txt_batches中所有batch文件的多余换行
+    
+    换行先由line_repair在本地按规则修复，只有规则无法确定的片段才调用LLM（use_llm为False时这些换行全部保留）。
+    文件由线程池并发处理，API请求经令牌桶限速；完成的文件原子写回并记入检查点日志，中断后重跑会跳过它们
+    """
+    resolve = make_llm_resolver() if use_llm else None
+
+    def process(input_text):
+        # 本地修复换行符，不确定的片段才调用API
+        result, stats = repair_line_breaks(input_text, resolve)
+        message = (f"{stats['lines']}行，去掉页码/页眉{stats['artefacts']}行，合并{stats['joined']}处，"
+                   f"不确定{stats['ambiguous']}处，调用LLM {stats['llm_spans']}次"
+                   f"（失败{stats['llm_failed']}次，结果改动原文被拒绝{stats['llm_rejected']}次）")
+        # 重试用尽仍失败（断网、配额用完）时不写回也不记入检查点，重跑时重新处理
+        if stats["llm_failed"]:
+            return None, message
+        return result, message
 
     """处理指定目录下的文本文件，修复换行符问题"""
     if base_dir is None:
         base_dir = os.getenv('txt_base_dir', "D:/课程作业/2025秋/人工智能/HW2/数据库-哈利波特/txt_batches")
     
-    n = 1
-    while True:
-        filename = os.path.join(base_dir, f'batch_{n}.txt')
-        
-        if not os.path.exists(filename):
-            print(f"\033[91m未检测到文件：\033[0m{filename}")
-            break
-            
-        print(f"\033[94m正在处理文件：\033[0m{filename}")
-        
-        # 读取文件内容
-        with open(filename, 'r', encoding='utf-8') as file:
-            input_text = file.read()
-        
-        # 调用API修复换行符
-        result = fix_line_breaks(input_text)
-        
-        if result:
-            # 写回清理后的内容
-            with open(filename, 'w', encoding='utf-8') as file:
-                file.write(result)
-            print(f"\033[92m已修复换行符：\033[0mbatch_{n}.txt")
-        else:
-            print(f"\033[91m处理失败：\033[0mbatch_{n}.txt")
-            
-        n += 1
+    start_time = time.perf_counter()
+    summary = run_batches(base_dir, process, JOURNAL_NAME, max_workers)
+    print(f"\033[94m换行修复完成：\033[0m新处理{summary['done']}个，跳过{summary['skipped']}个，"
+          f"失败{summary['failed']}个，用时{time.perf_counter() - start_time:.1f}秒")
+    return summary
 
 if __name__ == '__main__':
     base_dir = os.getenv('txt_base_dir', "D:/课程作业/2025秋/人工智能/HW2/数据库-哈利波特/txt_batches")
@@ -0,0 +1,171 @@
+import re
+from collections import Counter
+
+# 句末标点：上一行以这些字符结尾时保留换行（：通常引出下一行的对话）
+TERMINAL_PUNCTUATION = "。！？!?”」』：…"
+# 句末标点之后可能跟着的右括号、引号，判断时先去掉
+CLOSING_MARKS = "）)’\"'"
+# 章节标题单独成行，前后都保留换行
+HEADING_PATTERN = re.compile(r"^第[0-9０-９一二三四五六七八九十百千零〇两]+章")
+# 页码行：12、- 12 -、第12页、12/300 等
+PAGE_NUMBER_PATTERN = re.compile(r"^[-—\s]*(第\s*)?[0-9０-９]+(\s*页)?(\s*/\s*[0-9]+)?[-—\s]*$")
+# 反复出现的短行视为页眉页脚（书名等），对话等带标点的行和目录中“版权”之类的短词不算
+HEADER_MIN_LENGTH = 4
+HEADER_MAX_LENGTH = 20
+HEADER_MIN_REPEATS = 5
+# 排版折行的行长几乎相同：最常见的行长（允许相差1个字）至少占全部行的这个比例时才认为存在固定行宽
+FULL_WIDTH_MIN_SHARE = 0.1
+# 超过这个行宽的行所占比例的上限，超过时认为没有固定行宽
+FULL_WIDTH_MAX_LONGER = 0.05
+# 无标点结尾的行达到行宽的这个比例时直接合并，更短的行可能是真正的段落结尾，交给LLM判断
+SHORT_LINE_RATIO = 0.8
+
+JOIN = "join"
+BREAK = "break"
+AMBIGUOUS = "ambiguous"
+
+
+def _is_artefact(line, repeated):
+    return bool(PAGE_NUMBER_PATTERN.match(line)) or line in repeated
+
+def _repeated_headers(lines):
+    """统计反复出现、不含标点和引号的短行（每页重复的书名、页眉等）"""
+    counts = Counter(line for line in lines if HEADER_MIN_LENGTH <= len(line) <= HEADER_MAX_LENGTH)
+    return {
+        line for line, count in counts.items()
+        if count >= HEADER_MIN_REPEATS
+        and not HEADING_PATTERN.match(line)
+        and not re.search(r"[，。！？!?：；“”「」『』]", line)
+    }
+
+def _full_width(lines):
+    """
+    排版的整行宽度：被折断的整行长度几乎相同，取最常见的行长
+
+    最常见的行长（±1）占比不足FULL_WIDTH_MIN_SHARE时认为文本没有固定行宽（例如已经按段落分行），返回0
+    """
+    counts = Counter(len(line) for line in lines if len(line) >= 8)
+    if not counts:
+        return 0
+    width = max(counts, key=lambda length: (counts[length - 1] + counts[length] + counts[length + 1], length))
+    if counts[width - 1] + counts[width] + counts[width + 1] < max(3, len(lines) * FULL_WIDTH_MIN_SHARE):
+        return 0
+    # 固定行宽下几乎没有更长的行；按段落分行的文本里长段落很多，最常见的行长只是碰巧集中的短行
+    if sum(1 for line in lines if len(line) > width + 1) > len(lines) * FULL_WIDTH_MAX_LONGER:
+        return 0
+    return width
+
+def _ends_sentence(line):
+    stripped = line.rstrip(CLOSING_MARKS)
+    return bool(stripped) and stripped[-1] in TERMINAL_PUNCTUATION
+
+def _decide(previous, current, full_width):
+    """决定两行之间的换行是去掉、保留还是交给LLM"""
+    if HEADING_PATTERN.match(previous) or HEADING_PATTERN.match(current):
+        return BREAK
+    if _ends_sentence(previous):
+        # 句末标点恰好落在整行末尾时，可能是段落结尾，也可能只是句子结尾后折行
+        if full_width and len(previous) >= full_width - 1:
+            return AMBIGUOUS
+        return BREAK
+    if previous.endswith("——"):
+        # 破折号结尾可能是被打断的对话，也可能只是折行
+        return AMBIGUOUS
+    if not full_width or len(previous) < full_width * SHORT_LINE_RATIO or current[0] in "“「『":
+        return AMBIGUOUS
+    return JOIN
+
+def _join(left, right):
+    # 两边都是西文字母或数字时补一个空格，中文直接相连
+    if left[-1].isascii() and left[-1].isalnum() and right[0].isascii() and right[0].isalnum():
+        return left + " " + right
+    return left + right
+
+def _breaks_from_llm(span_lines, result):
+    """
+    根据LLM的返回结果决定片段内每个换行是否保留
+
+    只接受去掉空白后与原文完全一致的结果（LLM不能改动内容），否则返回None
+    """
+    original = "".join("".join(line.split()) for line in span_lines)
+    if result is None or "".join(result.split()) != original:
+        return None
+    # 结果中每个换行之前的非空白字符数
+    kept = set()
+    count = 0
+    for char in result:
+        if char == "\n":
+            kept.add(count)
+        elif not char.isspace():
+            count += 1
+    breaks = []
+    count = 0
+    for line in span_lines[:-1]:
+        count += len("".join(line.split()))
+        breaks.append(count in kept)
+    return breaks
+
+def repair_line_breaks(text, resolve=None):
+    """
+    在本地修复PDF排版造成的多余换行
+
+    规则：去掉页码和反复出现的页眉；章节标题单独成行；上一行以句末标点结尾且不满一整行时保留换行，
+    以其他字符结尾且接近排版行宽时去掉换行；其余情况（句末标点正好在行尾、短行、没有固定行宽、
+    下一行以引号开头、破折号结尾）
+    视为不确定，把连续的不确定行作为一个片段交给resolve（通常是LLM）判断。
+    没有resolve或结果无效时保留这些换行，保证不会改动原文内容。
+    resolve调用失败（返回None）记入llm_failed，结果改动了原文记入llm_rejected；
+    调用方应在llm_failed不为0时放弃结果，留待重跑时重试。
+
+    参数:
+        text (str): 原始文本
+        resolve (callable): resolve(片段文本) -> 修复换行后的片段文本，失败时返回None
+
+    返回:
+        tuple: (修复后的文本, 统计信息字典)
+    """
+    raw_lines = [line.strip() for line in text.replace("\\n", "\n").split("\n")]
+    raw_lines = [line for line in raw_lines if line]
+    repeated = _repeated_headers(raw_lines)
+    lines = [line for line in raw_lines if not _is_artefact(line, repeated)]
+    stats = {"lines": len(raw_lines), "artefacts": len(raw_lines) - len(lines),
+             "joined": 0, "ambiguous": 0, "llm_spans": 0, "llm_failed": 0, "llm_rejected": 0}
+    if not lines:
+        return "", stats
+
+    full_width = _full_width(lines)
+    decisions = [_decide(previous, current, full_width) for previous, current in zip(lines, lines[1:])]
+
+    # 连续的不确定换行合并成一个片段，一次交给resolve
+    i = 0
+    while i < len(decisions):
+        if decisions[i] != AMBIGUOUS:
+            i += 1
+            continue
+        j = i
+        while j < len(decisions) and decisions[j] == AMBIGUOUS:
+            j += 1
+        stats["ambiguous"] += j - i
+        breaks = None
+        if resolve is not None:
+            span_lines = lines[i:j + 1]
+            stats["llm_spans"] += 1
+            response = resolve("\n".join(span_lines))
+            if response is None:
+                stats["llm_failed"] += 1
+            else:
+                breaks = _breaks_from_llm(span_lines, response)
+                if breaks is None:
+                    stats["llm_rejected"] += 1
+        for k in range(i, j):
+            decisions[k] = JOIN if breaks is not None and not breaks[k - i] else BREAK
+        i = j
+
+    paragraphs = [lines[0]]
+    for decision, line in zip(decisions, lines[1:]):
+        if decision == JOIN:
+            paragraphs[-1] = _join(paragraphs[-1], line)
+            stats["joined"] += 1
+        else:
+            paragraphs.append(line)
+    return "\n".join(paragraphs) + "\n", stats
@@ -0,0 +1,83 @@
+import time
+import threading
+from line_repair import repair_line_breaks
+
+# ===== 清洗步骤：每一步接收一个行的迭代器，返回新的行迭代器 =====
+
+def split_lines(text):
+    """把文件内容切分为行（PDF提取时写入的字面\\n也当作换行）"""
+    for line in text.replace('\\n', '\n').split('\n'):
+        yield line
+
+def remove_empty_lines(lines):
+    """去掉空行（与remove_empty_lines.py的规则一致）"""
+    for line in lines:
+        if line.strip():
+            yield line
+
+def repair_breaks(resolve=None):
+    """
+    修复多余换行的步骤，resolve为判断不确定片段的函数（为None时不调用LLM）
+
+    页眉识别和行宽估计需要整个文件的统计信息，这一步先在内存中收集完所有行再输出。
+    有LLM调用在重试用尽后仍失败时抛出异常，整个文件不写入也不记入检查点，重跑时重新处理
+    """
+    def stage(lines):
+        result, stats = repair_line_breaks("\n".join(lines), resolve)
+        if stats["llm_failed"]:
+            raise RuntimeError(f"LLM调用失败{stats['llm_failed']}次（共{stats['llm_spans']}次），本文件留待重跑")
+        yield from result.split("\n")
+    stage.__name__ = "repair_breaks"
+    return stage
+
+
+class CleaningPipeline:
+    """
+    单遍清洗流水线：把文件内容依次流过各个清洗步骤，全部在内存中完成，只写一次结果
+
+    每个步骤是生成器函数（行迭代器 -> 行迭代器），按顺序串联（同一个步骤可以出现多次）。
+    统计每个步骤本身的耗时（不含上游步骤），多个线程同时处理不同文件时累加到同一份统计中
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        # 步骤名前加序号，重复出现的步骤分别计时
+        self.names = ["0.split_lines"] + [f"{i}.{stage.__name__}" for i, stage in enumerate(stages, 1)]
+        self.timings = {name: 0.0 for name in self.names}
+        self._lock = threading.Lock()
+
+    def _timed(self, lines, name, elapsed):
+        """包装一个步骤的输出，elapsed[name]累加该步骤产生每一行的耗时（含上游）"""
+        iterator = iter(lines)
+        while True:
+            start = time.perf_counter()
+            try:
+                line = next(iterator)
+            except StopIteration:
+                elapsed[name] += time.perf_counter() - start
+                return
+            elapsed[name] += time.perf_counter() - start
+            yield line
+
+    def run(self, text):
+        """
+        处理一个文件的内容
+
+        返回:
+            tuple: (清洗后的文本, {步骤名: 本文件中该步骤的耗时秒数})
+        """
+        elapsed = {name: 0.0 for name in self.names}
+        lines = self._timed(split_lines(text), self.names[0], elapsed)
+        for stage, name in zip(self.stages, self.names[1:]):
+            lines = self._timed(stage(lines), name, elapsed)
+        result = "".join(line + "\n" for line in lines)
+
+        # 每个步骤的计时包含了上游步骤，减去上一步的计时得到步骤本身的耗时
+        own = {}
+        upstream = 0.0
+        for name in self.names:
+            own[name] = elapsed[name] - upstream
+            upstream = elapsed[name]
+        with self._lock:
+            for name, seconds in own.items():
+                self.timings[name] += seconds
+        return result, own
@@ -1,7 +1,9 @@
 import os
+import json
 import importlib.util
 import time
 from openai import OpenAI
+from llm_stream import stream_chat_completion
 from dotenv import load_dotenv
 load_dotenv()
 import socket
@@ -65,7 +67,6 @@ Internet_timeout = 10              # 网络超时时间（秒）
 MAX_QUERY = 4                      # 最大查询文本数量
 INITIAL_QUERY_COUNT = 1            # 初始查询文本数量
 QUERY_INCREMENT = 1                # 每次查询增加的文本数量
-STREAM_TIMEOUT = 3.0               # 流式传输超时时间（秒）
 
 client = OpenAI(
     api_key=os.getenv("API_KEY"),
@@ -263,8 +264,7 @@ while True:
             api_kwargs = {
                 "model": "deepseek-chat",
                 "messages": messages,
-                "timeout": Internet_timeout,
-                "stream": True  # 改回流式传输
+                "timeout": Internet_timeout
             }
                 
             # 添加工具调用支持
@@ -272,64 +272,26 @@ while True:
                 api_kwargs["tools"] = [tool]
                 api_kwargs["tool_choice"] = tool_choice
                 
-            completion = client.chat.completions.create(**api_kwargs)
-            
-            response = ""
-            tool_call = None
-            
-            # 处理流式响应 - 改进多行文本处理
-            response = ""
-            tool_call = None
-            last_content_time = time.time()
-            
-            for chunk in completion:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    response += content
-                    print(content, end="", flush=True)  # Stream output
-                    last_content_time = time.time()  # 更新最后内容时间
-                    
-                # 处理工具调用
-                if hasattr(chunk.choices[0].delta, "tool_call") and chunk.choices[0].delta.tool_call:
-                    tool_call = chunk.choices[0].delta.tool_call
-                    last_content_time = time.time()  # 工具调用也更新计时器
-            
-            # 等待一小段时间确保流完全结束
-            while time.time() - last_content_time < STREAM_TIMEOUT:
-                time.sleep(0.1)
-            
-            print()  # Newline after streaming completes
+            # 处理流式响应：流结束时立即返回，工具调用按index拼接各个片段
+            response, tool_calls = stream_chat_completion(client, **api_kwargs)
+            tool_call = tool_calls[0] if tool_calls else None
             
             # 处理工具调用响应
             if tool_call and faiss_module:
                 try:
                     # 执行工具调用
-                    tool_response = faiss_module.search_harry_potter_context(**tool_call.function.arguments)
+                    tool_args = json.loads(tool_call["function"]["arguments"])
+                    tool_response = faiss_module.question_to_context(**tool_args)
                     # 将工具调用和响应添加到消息历史
-                    messages.append({'role': 'assistant', 'content': '', 'tool_call': tool_call})
-                    messages.append({'role': 'tool', 'content': tool_response, 'name': tool_choice})
-                    # 重新调用API获取最终回复 - 改回流式传输
-                    completion = client.chat.completions.create(
+                    messages.append({'role': 'assistant', 'content': '', 'tool_calls': [tool_call]})
+                    messages.append({'role': 'tool', 'content': str(tool_response), 'tool_call_id': tool_call["id"]})
+                    # 重新调用API获取最终回复 - 流式传输
+                    response, _ = stream_chat_completion(
+                        client,
                         model="deepseek-chat",
                         messages=messages,
-                        timeout=Internet_timeout,
-                        stream=True  # 改回流式传输
+                        timeout=Internet_timeout
                     )
-                    response = ""
-                    last_content_time = time.time()
-                    
-                    for chunk in completion:
-                        if chunk.choices[0].delta.content:
-                            content = chunk.choices[0].delta.content
-                            response += content
-                            print(content, end="", flush=True)  # Stream output
-                            last_content_time = time.time()  # 更新最后内容时间
-                    
-                    # 等待一小段时间确保流完全结束
-                    while time.time() - last_content_time < STREAM_TIMEOUT:
-                        time.sleep(0.1)
-                    
-                    print()  # Newline after streaming completes
                 except Exception as e:
                     print(f"\033[93m警告：工具调用失败: {e}\033[0m")
             
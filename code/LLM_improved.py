@@ -1,10 +1,13 @@
 import os
+import re
+import asyncio
 import importlib.util
 import time
-from openai import OpenAI
+from llm_stream import stream_chat_completion
+from http_client import make_openai_client, make_async_openai_client, connection_health
+from llm_cache import get_llm_cache
 from dotenv import load_dotenv
 load_dotenv()
-import socket
 
 # 动态加载哈利波特工具模块（如果存在）
 faiss_module = None
@@ -13,9 +16,13 @@ try:
     faiss_module_path = os.path.abspath('D:/同步文件/课程作业/2025秋/人工智能/HW2/.aux/数据库-哈利波特/harrypotter_agent_FAISS.py')
     if os.path.exists(faiss_module_path):
         spec = importlib.util.spec_from_file_location("harrypotter_agent_FAISS", faiss_module_path)
-        faiss_module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(faiss_module)
-        question_to_context = faiss_module.question_to_context
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # 启动时预热：模型和索引只加载一次，之后每次查询只做编码和FAISS搜索
+        # 预热成功后才启用工具，预热失败时按模块不存在处理，不会调用半初始化的检索器
+        module.warm_up()
+        faiss_module = module
+        question_to_context = module.question_to_context
         print("\033[94m哈利波特搜索工具已加载\033[0m")
     else:
         print("\033[93m警告：哈利波特搜索工具模块不存在，将跳过相关功能\033[0m")
@@ -44,33 +51,192 @@ tool = {
 # 对于deepseek模型，tool_choice应该使用"none"或"auto"
 tool_choice = "auto"
 
-def is_connected_to_Internet(host="8.8.8.8", port=53, timeout=3):
-    """
-    尝试连接到 Google DNS（8.8.8.8:53），判断是否联网。
-    可自定义 host/port。
-    """
-    try:
-        socket.setdefaulttimeout(timeout)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((host, port))
-        s.close()
-        return True
-    except Exception:
-        return False
-
 # ===== 可调参数配置 =====
 Internet_timeout = 10              # 网络超时时间（秒）
 MAX_QUERY = 6                      # 最大查询文本数量
 INITIAL_QUERY_COUNT = 1            # 初始查询文本数量
 QUERY_INCREMENT = 1                # 每次查询增加的文本数量
+LLM_CALL_TIMEOUT = 30              # 检索流水线中单次LLM调用的超时时间（秒）
+MAX_CONCURRENT_LLM_CALLS = 4       # 检索流水线中同时进行的LLM调用数上限
+EXTRACTION_MAX_TOKENS = 200        # 每个文本单独提取相关语句时的输出token上限
+LOCAL_EXTRACTION = True            # 用本地句子向量和MMR抽取相关语句（不调用LLM）；为False时让LLM逐个文本提取
+TOPIC_GATE_LLM_FALLBACK = True     # 本地话题判断分数落在不确定区间时是否交给LLM判断（否则按阈值直接判断）
+
+# 同步和异步客户端都使用http_client.py中的共享连接配置（keep-alive连接池）
+client = make_openai_client(os.getenv("API_KEY"), "https://api.deepseek.com")
 
-client = OpenAI(
-    api_key=os.getenv("API_KEY"),
-    base_url="https://api.deepseek.com",
-)
+# 检索流水线使用的异步客户端，所有异步调用共享同一个连接池
+async_client = make_async_openai_client(os.getenv("API_KEY"), "https://api.deepseek.com")
+# 整个会话复用同一个事件循环，连接池才能跨轮次保持
+event_loop = asyncio.new_event_loop()
+# 限制同时进行的LLM调用数量
+llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+# 分类、关键词提取、语句提取和核验的回复缓存（重复的问题不再重复付费调用）
+llm_cache = get_llm_cache()
 
 api_key = os.getenv("API_KEY")
 
+async def _chat_async(messages, max_tokens, use_cache=False):
+    """
+    异步调用LLM，返回去掉首尾空白的回复文本；超过LLM_CALL_TIMEOUT秒视为失败
+
+    use_cache为True时先查本地回复缓存（只用于输出由输入决定的子调用），命中则不发请求
+    """
+    if use_cache:
+        cache_key = llm_cache.make_key("deepseek-chat", messages, max_tokens=max_tokens)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    async with llm_semaphore:
+        # 由真实请求的结果更新网络状态
+        response = await connection_health.call_async(asyncio.wait_for(
+            async_client.chat.completions.create(
+                model="deepseek-chat",
+                messages=messages,
+                max_tokens=max_tokens,
+                timeout=LLM_CALL_TIMEOUT,
+                stream=False
+            ),
+            timeout=LLM_CALL_TIMEOUT
+        ))
+    result = response.choices[0].message.content.strip()
+    if use_cache and result:
+        llm_cache.put(cache_key, result)
+    return result
+
+async def _extract_from_passage(user_input, search_keywords, passage_text):
+    """map：从单个文本中提取相关语句，每个文本有独立的输出token预算；没有相关信息时返回空字符串"""
+    extraction_prompt = {
+        "role": "system",
+        "content": f"用户的问题是：{user_input}\n\n关键词是：{search_keywords}\n\n以下是查询到的文本信息：\n{passage_text}\n\n请从这些文本中选出与关键词相关的语句（可以是和一个或几个关键词有关，只要他有可能有益于回答用户的问题）（可以是不同的几段）。如果文本中没有任何相关信息，请返回空列表。请只返回相关的语句，不要解释。"
+    }
+    extracted_text = await _chat_async([extraction_prompt], EXTRACTION_MAX_TOKENS, use_cache=True)
+    if not extracted_text or extracted_text == "空列表" or extracted_text == "[]":
+        return ""
+    return extracted_text
+
+def _merge_extractions(extractions, seen_sentences):
+    """reduce：按句子去掉各文本提取结果中的重复语句（包括之前轮次已提取过的），保持原有顺序合并"""
+    merged_lines = []
+    for text in extractions:
+        for line in text.split("\n"):
+            kept = []
+            for sentence in re.split(r"(?<=[。！？!?])", line):
+                key = re.sub(r"\s+", "", sentence)
+                if key and key not in seen_sentences:
+                    seen_sentences.add(key)
+                    kept.append(sentence.strip())
+            if kept:
+                merged_lines.append("".join(kept))
+    return "\n".join(merged_lines)
+
+async def retrieve_harry_potter_context(user_input):
+    """
+    哈利波特问题的异步检索流水线：问题分类 -> 关键词提取 -> 渐进式查询与核验
+    
+    返回:
+        tuple: (是否调用了哈利波特搜索工具, 提取到的相关信息列表, 信息是否足够)
+    """
+    # 创建系统提示让LLM判断是否需要调用哈利波特工具
+    system_prompt = {
+        "role": "system",
+        "content": "请分析用户的问题，判断是否与哈利波特相关。如果问题涉及哈利波特、魔法、霍格沃茨、伏地魔、魔法石、魁地奇等哈利波特相关主题，请返回YES，否则返回NO。只返回YES或NO，不要解释。"
+    }
+    
+    # 让LLM思考需要哪些关键词
+    keyword_prompt = {
+        "role": "system",
+        "content": f"用户的问题是：{user_input}\n\n请思考：要回答这个问题，需要从哈利波特原文中查找哪些信息？注意：原始文献仅包含哈利波特系列小说的原文内容，不包含外部知识。请提取最相关的关键词，这些关键词应该简洁且直接与哈利波特原文内容相关。请只返回关键词，用空格连接，不要解释。\n\n示例：\n- 问题：哈利波特今年几岁了？\n- 关键词：哈利波特 出生\n- 问题：赫敏的魔杖是什么材质的？\n- 关键词：赫敏 魔杖 材质\n- 问题：伏地魔有几个魂器？\n- 关键词：伏地魔 魂器 数量"
+    }
+    
+    # 先用本地话题判断（基于已加载的向量模型和索引，毫秒级），明确相关或无关时不再调用LLM
+    judgment, topic_score = await asyncio.to_thread(faiss_module.classify_topic, user_input, TOPIC_GATE_LLM_FALLBACK)
+    if judgment == "NO":
+        return False, [], False
+    if topic_score is not None:
+        print(f"\033[94m本地话题判断：{judgment}（分数 {topic_score:.3f}）\033[0m")
+    
+    # 分类和关键词提取互不依赖，同时发出；判断为无关问题时直接丢弃关键词结果
+    keyword_task = asyncio.create_task(_chat_async([keyword_prompt], 50, use_cache=True))
+    if judgment == "UNCERTAIN":
+        # 只有分数落在不确定区间（或没有话题判断文件）时才让LLM判断
+        judgment_task = asyncio.create_task(_chat_async([system_prompt, {'role': 'user', 'content': user_input}], 10, use_cache=True))
+        try:
+            judgment = (await judgment_task).upper()
+        except BaseException:
+            keyword_task.cancel()
+            raise
+        if judgment != "YES":
+            keyword_task.cancel()
+            return False, [], False
+    
+    print("\033[94m检测到哈利波特相关问题，将调用搜索工具...\033[0m")
+    search_keywords = await keyword_task
+    print(f"\033[94m提取的关键词：{search_keywords}\033[0m")
+    
+    # 改进的反复核验机制：每次查询都提取新增文本中的相关语句，再让LLM核验信息是否足够
+    extracted_contexts_list = []  # 存储每个查询轮次提取的相关语句列表
+    seen_sentences = set()  # 已经提取过的语句，用于跨文本、跨轮次去重
+    current_query_count = 0  # 已经取用的文本数量
+    next_query_count = INITIAL_QUERY_COUNT  # 本轮新增的文本数量
+    sufficient_context_found = False
+    
+    # 只按MAX_QUERY搜索一次，之后每轮按排名顺序取出尚未处理过的文本（向量检索在线程中执行，不阻塞事件循环）
+    retrieval_session = await asyncio.to_thread(faiss_module.start_retrieval_session, search_keywords, MAX_QUERY)
+    
+    while current_query_count < MAX_QUERY and not sufficient_context_found:
+        # 本轮只取新的文本，已经提取过的文本不再重复发送给LLM
+        new_passages = retrieval_session.next(min(next_query_count, MAX_QUERY - current_query_count))
+        current_contexts = [passage["text"] for passage in new_passages]
+        next_query_count = QUERY_INCREMENT
+        if not current_contexts:
+            break
+        
+        current_query_count += len(current_contexts)
+        print(f"\033[94m查询到{current_query_count}个文本，正在提取新增{len(current_contexts)}个文本中的相关信息...\033[0m")
+        
+        if LOCAL_EXTRACTION:
+            # 本地从本轮新增的文本中抽取与问题和关键词最相关的句子（一次批量编码，不发网络请求）
+            extractions = await asyncio.to_thread(
+                faiss_module.compress_passages, f"{user_input} {search_keywords}", current_contexts
+            )
+        else:
+            # 让LLM从本轮新增的每个文本中并发提取相关语句
+            extractions = await asyncio.gather(
+                *(_extract_from_passage(user_input, search_keywords, text) for text in current_contexts)
+            )
+        # 合并去重
+        extracted_text = _merge_extractions(extractions, seen_sentences)
+        
+        # 将提取的语句添加到列表中（可以是空列表）
+        if extracted_text:
+            extracted_contexts_list.append(extracted_text)
+            print(f"\033[94m第{current_query_count}批文本提取到相关信息\033[0m")
+        else:
+            extracted_contexts_list.append("")  # 空列表
+            print(f"\033[94m第{current_query_count}批文本未提取到相关信息\033[0m")
+        
+        # 检查当前所有提取的信息是否足够
+        if any(extracted_contexts_list):  # 至少有一个非空列表
+            verification_prompt = {
+                "role": "system",
+                "content": f"以下是到目前为止提取的所有相关信息：\n{'\n'.join([ctx for ctx in extracted_contexts_list if ctx])}\n\n请判断你已有的知识加上这些信息是否足够回答用户的问题（“{user_input}”）？如果这些信息帮助你知道答案了，请返回YES；如果这些信息让你完全不知道怎么回答，请返回NO（否则都回答YES）。只返回YES或NO，不要解释。"
+            }
+            verification_result = (await _chat_async([verification_prompt], 10, use_cache=True)).upper()
+            
+            if verification_result == "NO":
+                print(f"\033[94m查询到{current_query_count}个文本，信息不足，继续查询...\033[0m")
+            else:
+                sufficient_context_found = True
+                print(f"\033[94m查询到{current_query_count}个文本，信息已足够\033[0m")
+        else:
+            # 如果没有任何提取的信息，继续查询
+            print(f"\033[94m查询到{current_query_count}个文本，未提取到相关信息，继续查询...\033[0m")
+    
+    # 打包所有提取的信息
+    all_extracted_contexts = [ctx for ctx in extracted_contexts_list if ctx]  # 过滤掉空列表
+    return True, all_extracted_contexts, sufficient_context_found
+
 messages = [
     {'role': 'system', 'content': '接下来你的每一个回答都不能是空的。\n\n当用户输入退出对话的指令（如"exit"）时，模型应返回固定结束语："Exiting the chat. Goodbye!"（不带引号）'}
 ]
@@ -102,108 +268,11 @@ while True:
     # 内部判断是否需要调用哈利波特工具
     if faiss_module and question_to_context:
         try:
-            # 创建系统提示让LLM判断是否需要调用哈利波特工具
-            system_prompt = {
-                "role": "system",
-                "content": "请分析用户的问题，判断是否与哈利波特相关。如果问题涉及哈利波特、魔法、霍格沃茨、伏地魔、魔法石、魁地奇等哈利波特相关主题，请返回YES，否则返回NO。只返回YES或NO，不要解释。"
-            }
-            
-            # 内部调用LLM判断
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[system_prompt, {'role': 'user', 'content': user_input}],
-                max_tokens=10,
-                stream=False
+            # 分类、关键词提取、渐进式查询都在异步流水线中完成
+            harry_potter_used, all_extracted_contexts, sufficient_context_found = event_loop.run_until_complete(
+                retrieve_harry_potter_context(user_input)
             )
-            
-            # 解析判断结果
-            judgment = response.choices[0].message.content.strip().upper()
-            if judgment == "YES":
-                print("\033[94m检测到哈利波特相关问题，将调用搜索工具...\033[0m")
-                harry_potter_used = True
-                
-                # 让LLM思考需要哪些关键词
-                keyword_prompt = {
-                    "role": "system",
-                    "content": f"用户的问题是：{user_input}\n\n请思考：要回答这个问题，需要从哈利波特原文中查找哪些信息？注意：原始文献仅包含哈利波特系列小说的原文内容，不包含外部知识。请提取最相关的关键词，这些关键词应该简洁且直接与哈利波特原文内容相关。请只返回关键词，用空格连接，不要解释。\n\n示例：\n- 问题：哈利波特今年几岁了？\n- 关键词：哈利波特 出生\n- 问题：赫敏的魔杖是什么材质的？\n- 关键词：赫敏 魔杖 材质\n- 问题：伏地魔有几个魂器？\n- 关键词：伏地魔 魂器 数量"
-                }
-                
-                keyword_response = client.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[keyword_prompt],
-                    max_tokens=50,
-                    stream=False
-                )
-                
-                search_keywords = keyword_response.choices[0].message.content.strip()
-                print(f"\033[94m提取的关键词：{search_keywords}\033[0m")
-                
-                # 改进的反复核验机制：每次查询都让LLM提取相关语句
-                extracted_contexts_list = []  # 存储每个查询轮次提取的相关语句列表
-                current_query_count = INITIAL_QUERY_COUNT  # 初始查询文本数量
-                sufficient_context_found = False
-                
-                while current_query_count <= MAX_QUERY and not sufficient_context_found:
-                    # 使用提取的关键词调用哈利波特搜索工具，只获取当前查询数量的文本
-                    current_contexts = question_to_context(search_keywords, top_batches=current_query_count)
-                    if current_contexts:
-                        print(f"\033[94m查询到{current_query_count}个文本，正在提取相关信息...\033[0m")
-                        
-                        # 让LLM从当前查询的文本中提取相关语句
-                        extraction_prompt = {
-                            "role": "system",
-                            "content": f"用户的问题是：{user_input}\n\n关键词是：{search_keywords}\n\n以下是第{current_query_count}批查询到的文本信息：\n{'\n'.join(current_contexts)}\n\n请从这些文本中选出与关键词相关的语句（可以是和一个或几个关键词有关，只要他有可能有益于回答用户的问题）（可以是不同的几段）。如果文本中没有任何相关信息，请返回空列表。请只返回相关的语句，不要解释。"
-                        }
-                        
-                        extraction_response = client.chat.completions.create(
-                            model="deepseek-chat",
-                            messages=[extraction_prompt],
-                            max_tokens=200,
-                            stream=False
-                        )
-                        
-                        extracted_text = extraction_response.choices[0].message.content.strip()
-                        
-                        # 将提取的语句添加到列表中（可以是空列表）
-                        if extracted_text and extracted_text != "空列表" and extracted_text != "[]":
-                            extracted_contexts_list.append(extracted_text)
-                            print(f"\033[94m第{current_query_count}批文本提取到相关信息\033[0m")
-                        else:
-                            extracted_contexts_list.append("")  # 空列表
-                            print(f"\033[94m第{current_query_count}批文本未提取到相关信息\033[0m")
-                        
-                        # 检查当前所有提取的信息是否足够
-                        if extracted_contexts_list and any(extracted_contexts_list):  # 至少有一个非空列表
-                            verification_prompt = {
-                                "role": "system",
-                                "content": f"以下是到目前为止提取的所有相关信息：\n{'\n'.join([ctx for ctx in extracted_contexts_list if ctx])}\n\n请判断你已有的知识加上这些信息是否足够回答用户的问题（“{user_input}”）？如果这些信息帮助你知道答案了，请返回YES；如果这些信息让你完全不知道怎么回答，请返回NO（否则都回答YES）。只返回YES或NO，不要解释。"
-                            }
-                            
-                            verification_response = client.chat.completions.create(
-                                model="deepseek-chat",
-                                messages=[verification_prompt],
-                                max_tokens=10,
-                                stream=False
-                            )
-                            
-                            verification_result = verification_response.choices[0].message.content.strip().upper()
-                            
-                            if verification_result == "NO":
-                                print(f"\033[94m查询到{current_query_count}个文本，信息不足，继续查询...\033[0m")
-                                current_query_count += QUERY_INCREMENT  # 每次增加文本数量
-                            else:
-                                sufficient_context_found = True
-                                print(f"\033[94m查询到{current_query_count}个文本，信息已足够\033[0m")
-                        else:
-                            # 如果没有任何提取的信息，继续查询
-                            print(f"\033[94m查询到{current_query_count}个文本，未提取到相关信息，继续查询...\033[0m")
-                            current_query_count += QUERY_INCREMENT
-                    else:
-                        break
-                
-                # 打包所有提取的信息
-                all_extracted_contexts = [ctx for ctx in extracted_contexts_list if ctx]  # 过滤掉空列表
-                
+            if harry_potter_used:
                 if all_extracted_contexts:
                     if sufficient_context_found:
                         # 添加上下文到消息历史 - 使用所有提取的相关信息
@@ -242,17 +311,16 @@ while True:
     
     exit_flag = False
     try:
-        # 网络检查
-        if not is_connected_to_Internet():
-            print("Error: No Network connection. Please check your internet connection.")
+        # 网络检查：根据最近请求的结果判断，最近连接失败时在退避期内直接跳过请求
+        if not connection_health.is_available():
+            print(f"Error: No Network connection. Please check your internet connection and retry in {connection_health.seconds_until_retry():.0f} seconds.")
             continue
             
-        # 创建API调用参数 - 取消流式传输
+        # 创建API调用参数 - 流式传输，边生成边输出
         api_kwargs = {
             "model": "deepseek-chat",
             "messages": messages,
-            "timeout": Internet_timeout,
-            "stream": False  # 取消流式传输
+            "timeout": Internet_timeout
         }
             
         # 添加工具调用支持
@@ -260,49 +328,33 @@ while True:
             api_kwargs["tools"] = [tool]
             api_kwargs["tool_choice"] = tool_choice
             
-        completion = client.chat.completions.create(**api_kwargs)
-        
-        response = completion.choices[0].message.content
-        tool_call = completion.choices[0].message.tool_calls[0] if completion.choices[0].message.tool_calls else None
-        
-        # 直接打印完整响应
-        print(response)
+        response, tool_calls = connection_health.call(stream_chat_completion, client, **api_kwargs)
+        tool_call = tool_calls[0] if tool_calls else None
         
         # 处理工具调用响应
         if tool_call and faiss_module:
             try:
                 # 解析工具调用参数（从字符串转换为字典）
                 import json
-                tool_args = json.loads(tool_call.function.arguments)
+                tool_args = json.loads(tool_call["function"]["arguments"])
                 
                 # 执行工具调用 - 使用正确的函数名 question_to_context
                 tool_response = faiss_module.question_to_context(**tool_args)
                 
-                # 将工具返回的信息添加到消息历史中 - 使用可序列化的格式
-                tool_call_dict = {
-                    "id": tool_call.id,
-                    "type": "function",
-                    "function": {
-                        "name": tool_call.function.name,
-                        "arguments": tool_call.function.arguments
-                    }
-                }
-                messages.append({'role': 'assistant', 'content': '', 'tool_calls': [tool_call_dict]})
+                # 将工具返回的信息添加到消息历史中 - 流式拼接得到的工具调用本身就是可序列化的字典
+                messages.append({'role': 'assistant', 'content': '', 'tool_calls': [tool_call]})
                 # 立即添加工具消息，内容为工具返回的实际信息，确保符合OpenAI API标准
-                messages.append({'role': 'tool', 'content': str(tool_response), 'tool_call_id': tool_call.id})
+                messages.append({'role': 'tool', 'content': str(tool_response), 'tool_call_id': tool_call["id"]})
                 
-                # 重新调用API获取最终回复 - 取消流式传输
-                completion = client.chat.completions.create(
+                # 重新调用API获取最终回复 - 同样流式输出
+                print("\033[93mAgent:\033[0m")
+                response, _ = connection_health.call(
+                    stream_chat_completion,
+                    client,
                     model="deepseek-chat",
                     messages=messages,
-                    timeout=Internet_timeout,
-                    stream=False  # 取消流式传输
+                    timeout=Internet_timeout
                 )
-                response = completion.choices[0].message.content
-                
-                # 直接打印最终回复
-                print("\033[93mAgent:\033[0m")
-                print(response)
                 
             except Exception as e:
                 print(f"\033[93m警告：工具调用失败: {e}\033[0m")
@@ -333,16 +385,15 @@ while True:
                 # 显示agent回答
                 print("\033[93mAgent:\033[0m")
                 
-                # 调用API获取解释
-                explanation_response = client.chat.completions.create(
+                # 调用API获取解释（流式输出）
+                explanation, _ = connection_health.call(
+                    stream_chat_completion,
+                    client,
                     model="deepseek-chat",
                     messages=messages,
-                    max_tokens=400,
-                    stream=False
+                    max_tokens=400
                 )
-                
-                explanation = explanation_response.choices[0].message.content.strip()
-                print(explanation)
+                explanation = explanation.strip()
                 print()
                 
                 # 将解释添加到消息历史中
@@ -389,6 +440,15 @@ while True:
     if exit_flag:
         break
 
+# 释放检索器占用的模型和索引
+if faiss_module:
+    faiss_module.shutdown()
+
+# 关闭异步连接池和事件循环
+event_loop.run_until_complete(async_client.close())
+event_loop.close()
+llm_cache.close()
+
 # Save messages to file after program execution
 
 base_dir = os.getenv("BASE_DIR", "default_conversation_dir")
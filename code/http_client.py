@@ -0,0 +1,98 @@
+import threading
+import time
+import httpx
+from openai import OpenAI, AsyncOpenAI, APIConnectionError
+
+# ===== 共享的HTTP连接配置（聊天程序和语料清洗脚本共用） =====
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)   # 连接超时5秒，读写超时60秒（只作用于这些客户端，不修改全局socket设置）
+HTTP_LIMITS = httpx.Limits(
+    max_connections=8,             # 连接池最大连接数
+    max_keepalive_connections=8,   # 保持复用的空闲连接数
+    keepalive_expiry=60.0          # 空闲连接保留时间（秒）
+)
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def get_http_client():
+    """进程内共享的keep-alive同步HTTP客户端"""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    return _http_client
+
+def new_async_http_client():
+    """创建使用同样连接配置的异步HTTP客户端（异步客户端绑定事件循环，每个事件循环各建一个）"""
+    return httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+def make_openai_client(api_key, base_url):
+    """创建复用共享连接池的OpenAI兼容客户端"""
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=get_http_client())
+
+def make_async_openai_client(api_key, base_url):
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=new_async_http_client())
+
+
+class ConnectionHealth:
+    """
+    根据真实请求的结果维护网络状态，不再单独探测8.8.8.8
+
+    请求成功后立即恢复为可用；连接失败后按指数退避（base_delay, 2*base_delay, ...，最多max_delay秒）
+    暂时标记为不可用，退避期内直接跳过请求，到期后放行下一次请求作为探测
+    """
+    def __init__(self, base_delay=1.0, max_delay=60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.consecutive_failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_available(self):
+        with self._lock:
+            return time.monotonic() >= self._retry_at
+
+    def seconds_until_retry(self):
+        with self._lock:
+            return max(0.0, self._retry_at - time.monotonic())
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._retry_at = 0.0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.consecutive_failures - 1))
+            self._retry_at = time.monotonic() + delay
+
+    def is_network_error(self, error):
+        """只有连接层面的错误和超时才计入网络状态（APITimeoutError是APIConnectionError的子类）"""
+        return isinstance(error, (APIConnectionError, httpx.TransportError, TimeoutError))
+
+    def call(self, func, *args, **kwargs):
+        """执行一次请求并记录结果，异常照常抛出"""
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.is_network_error(e):
+                self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, coro):
+        try:
+            result = await coro
+        except Exception as e:
+            if self.is_network_error(e):
+                self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+# 进程内共享的网络状态
+connection_health = ConnectionHealth()
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+# ===== LLM回复缓存配置 =====
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache.sqlite"))
+LLM_CACHE_TTL = 7 * 24 * 3600      # 缓存有效期（秒），超过后视为未命中
+LLM_CACHE_MAX_ENTRIES = 20000      # 最多保留的条目数，超出后按最近使用时间淘汰
+
+
+class LLMResponseCache:
+    """
+    确定性LLM子调用（分类、关键词提取、语句提取、核验、语料清洗）的本地持久化缓存
+
+    键是(model, messages, 其他请求参数)的sha256，值是回复文本，保存在SQLite文件中，
+    程序重启和清洗脚本重跑都能命中。条目超过ttl秒后失效；条目数超过max_entries时
+    删除最久未使用的条目。是否使用缓存由每个调用点自行决定。
+    """
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, messages, **params):
+        """对请求内容做规范化序列化后取哈希，参数顺序不影响键"""
+        payload = json.dumps({"model": model, "messages": messages, "params": params},
+                             ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """删除过期条目，再按最近使用时间删除超出上限的条目（调用方持有锁）"""
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        overflow = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                (overflow,)
+            )
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "size": size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache_instance = None
+_cache_lock = threading.Lock()
+
+def get_llm_cache():
+    """进程内共享的LLM回复缓存（首次使用时打开数据库文件）"""
+    global _cache_instance
+    if _cache_instance is None:
+        with _cache_lock:
+            if _cache_instance is None:
+                _cache_instance = LLMResponseCache()
+    return _cache_instance
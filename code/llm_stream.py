@@ -0,0 +1,42 @@
+def stream_chat_completion(client, **kwargs):
+    """
+    以流式方式调用LLM：边接收边打印内容，流结束（迭代器耗尽）时立即返回，不需要额外等待
+
+    工具调用在流中是分片到达的：同一个工具调用的各个片段带有相同的index，
+    id和函数名只在第一个片段中出现，arguments被拆成多段依次到达，需要按index拼接。
+
+    返回:
+        tuple: (完整回复文本, 工具调用列表)，工具调用为可直接放入消息历史的字典
+            {"id": ..., "type": "function", "function": {"name": ..., "arguments": ...}}
+    """
+    stream = client.chat.completions.create(stream=True, **kwargs)
+
+    content_parts = []
+    tool_calls = {}
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+
+        if delta.content:
+            content_parts.append(delta.content)
+            print(delta.content, end="", flush=True)  # Stream output
+
+        for tool_call_delta in delta.tool_calls or []:
+            tool_call = tool_calls.setdefault(tool_call_delta.index, {
+                "id": "",
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if tool_call_delta.id:
+                tool_call["id"] = tool_call_delta.id
+            if tool_call_delta.function:
+                if tool_call_delta.function.name:
+                    tool_call["function"]["name"] += tool_call_delta.function.name
+                if tool_call_delta.function.arguments:
+                    tool_call["function"]["arguments"] += tool_call_delta.function.arguments
+
+    if content_parts:
+        print()  # Newline after streaming completes
+
+    return "".join(content_parts), [tool_calls[index] for index in sorted(tool_calls)]